@@ -2,7 +2,7 @@
 #
 # Initial gRPC server implementation.
 # Depreciated in favour of a Message Queue Pattern approach.
-# Please use prompt_processor.py as your startup project.
+# Please use rag_prompt_processor.py as your startup project.
 #
 ################################################################################
 
@@ -10,23 +10,21 @@ import grpc
 from concurrent import futures
 import llama_service_pb2
 import llama_service_pb2_grpc
-from transformers import AutoModelForCausalLM, AutoTokenizer, pipeline
-import torch
+from transformers import LogitsProcessorList
+from llama_service import DeviceNoRepeatNGramLogitsProcessor
+from llama_weights import copy_to_device, get_model, get_tokenizer
 
 
 class LlamaService(llama_service_pb2_grpc.LlamaServiceServicer):
     def __init__(self):
         # Load the pre-trained Llama 3.2 3B Instruct model using Hugging Face's AutoModelForCausalLM.
         # This model is designed for causal language modeling tasks (e.g., text generation).
-        self.model = AutoModelForCausalLM.from_pretrained(
-            "meta-llama/Llama-3.2-3B-Instruct",             # Model identifier on Hugging Face Hub
-            device_map="auto",                              # Automatically distribute the model across available GPUs
-            torch_dtype=torch.float16                       # Use half-precision (16-bit floating point) for better performance
-        )
+        # The weights are shared with any other service loaded into the same process.
+        self.model = get_model()
 
         # Load the tokenizer associated with the Llama 3.2 3B Instruct model.
         # The tokenizer converts text into tokens (e.g., words or subwords) that the model can process.
-        self.tokenizer = AutoTokenizer.from_pretrained("meta-llama/Llama-3.2-3B-Instruct")
+        self.tokenizer = get_tokenizer()
 
 
     def GenerateText(self, request, context):
@@ -42,7 +40,11 @@ class LlamaService(llama_service_pb2_grpc.LlamaServiceServicer):
             truncation=True,                                # Enable truncation if the input exceeds the max_length
             max_length=512,                                 # Set the maximum number of tokens for the input
             truncation_strategy="longest_first"             # Truncate the longest part of the input if necessary
-        ).to("cuda")                                        # Move the tokenized inputs to the GPU for faster processing
+        )
+
+        # Move the tokenized inputs to the GPU for faster processing.
+        # The copy is made from pinned memory so it does not stall the host.
+        inputs = copy_to_device(inputs, self.model.device)
 
         # Generate text using the model.
         # The model takes the tokenized input and produces a sequence of tokens as output.
@@ -51,19 +53,19 @@ class LlamaService(llama_service_pb2_grpc.LlamaServiceServicer):
             attention_mask=inputs["attention_mask"],        # Attention mask to indicate which tokens are actual input
             max_new_tokens=1024,                            # Maximum number of new tokens to generate (excluding the input tokens)
             pad_token_id=self.tokenizer.eos_token_id,       # Use the end-of-sequence (EOS) token as the padding token
-            no_repeat_ngram_size=2,                         # Prevent the model from repeating 2-grams (pairs of words)
-            num_beams=5,                                    # Use beam search with 5 beams to explore multiple candidate sequences
-            early_stopping=True                             # Stop generation early if all beam candidates reach the EOS token
+            logits_processor=LogitsProcessorList([          # Prevent the model from repeating 2-grams (pairs of words),
+                DeviceNoRepeatNGramLogitsProcessor(2)       # checked on the GPU instead of in a Python loop
+            ]),
+            num_beams=1,                                    # Greedy decoding; a single sequence keeps a single KV cache
+            do_sample=False,                                # Deterministic output
+            use_cache=True                                  # Reuse past key/values between decoding steps
         )
 
-        # Decode the generated token IDs back into human-readable text.
+        # Decode only the newly generated token IDs back into human-readable text.
+        # The output starts with the prompt tokens, so slicing them off is exact and avoids decoding the prompt.
         # The `skip_special_tokens=True` argument removes special tokens like [EOS] from the output.
-        generated_text = self.tokenizer.decode(outputs[0], skip_special_tokens=True)
-
-        # Remove the input prompt from the generated text (if present).
-        # This ensures that only the newly generated text is returned.
-        if generated_text.startswith(prompt):
-            generated_text = generated_text[len(prompt):].strip()
+        input_length = inputs["input_ids"].shape[1]
+        generated_text = self.tokenizer.decode(outputs[0, input_length:], skip_special_tokens=True).strip()
 
         # Return the generated text as a gRPC response.
         return llama_service_pb2.TextResponse(generated_text=generated_text)
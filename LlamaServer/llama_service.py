@@ -1,12 +1,299 @@
+import copy
+import importlib.util
 import logging
-from typing import Optional
-import re
+import os
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional, Tuple
+import requests
 import torch
-from transformers import AutoModelForCausalLM, AutoTokenizer
+from transformers import (
+    DynamicCache, LogitsProcessor, LogitsProcessorList, QuantizedCacheConfig, RepetitionPenaltyLogitsProcessor, StaticCache,
+    TextStreamer,
+)
+from llama_weights import LLAMA_MODEL_ID, LLAMA_QUANTIZATION, copy_to_device, get_model, get_tokenizer, select_compute_dtype
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
 
+# Configuration
+LLAMA_BACKEND = os.getenv("LLAMA_BACKEND", "transformers")              # Inference engine: "transformers", "vllm" or "openai"
+LLAMA_SERVER_URL = os.getenv("LLAMA_SERVER_URL", "http://localhost:8000/v1")   # OpenAI-compatible server used by the "openai" backend
+LLAMA_SERVER_TIMEOUT = float(os.getenv("LLAMA_SERVER_TIMEOUT", 300))    # Seconds to wait for the server to answer a batch
+LLAMA_ASSISTANT_MODEL_ID = os.getenv("LLAMA_ASSISTANT_MODEL_ID", "")    # Optional draft model for speculative decoding (e.g. meta-llama/Llama-3.2-1B-Instruct)
+LLAMA_NUM_BEAMS = int(os.getenv("LLAMA_NUM_BEAMS", 1))                  # Beam width; 1 selects greedy decoding (keep it at 2 or less)
+LLAMA_TEMPERATURE = float(os.getenv("LLAMA_TEMPERATURE", 0))            # Sampling temperature for replies; 0 decodes greedily
+LLAMA_TOP_P = float(os.getenv("LLAMA_TOP_P", 0.9))                      # Nucleus sampling probability mass, when sampling
+LLAMA_KV_CACHE_BITS = int(os.getenv("LLAMA_KV_CACHE_BITS", 0))          # KV cache quantization (2 or 4 bits, requires optimum-quanto); 0 keeps FP16
+LLAMA_NO_REPEAT_NGRAM_SIZE = int(os.getenv("LLAMA_NO_REPEAT_NGRAM_SIZE", 0))    # Ban repeated n-grams of this size; 0 disables
+LLAMA_REPETITION_PENALTY = float(os.getenv("LLAMA_REPETITION_PENALTY", 1.0))    # Penalize tokens already in the sequence (e.g. 1.1); 1.0 disables
+LLAMA_TORCH_COMPILE = os.getenv("LLAMA_TORCH_COMPILE", "auto")        # Decode with a compiled, CUDA-graph-captured step: "1", "0", or "auto" (unquantized weights with Triton only, so off with the default nf4)
+LLAMA_PREFIX_CACHE = os.getenv("LLAMA_PREFIX_CACHE", "0") == "1"       # Start single prompts from pre-computed key/values of their constant prefix
+LLAMA_STATIC_CACHE_ROWS = int(os.getenv("LLAMA_STATIC_CACHE_ROWS", 8))     # Batch rows of compiled-decoding KV cache kept allocated across batch sizes
+LLAMA_MAX_INPUT_TOKENS = int(os.getenv("LLAMA_MAX_INPUT_TOKENS", 4096))     # Longer prompts are trimmed, keeping their start and end
+LLAMA_MAX_NEW_TOKENS = int(os.getenv("LLAMA_MAX_NEW_TOKENS", 512))          # Maximum number of tokens generated per reply; requests may ask for fewer
+LLAMA_PAD_TO_MULTIPLE_OF = int(os.getenv("LLAMA_PAD_TO_MULTIPLE_OF", 64))   # Pad prompt batches to a multiple of this length; 0 disables
+
+
+# Constant leading parts of the prompts. Each one ends on a newline, where the tokenizer always starts a new
+# token, so tokenizing a prefix on its own yields the same tokens as tokenizing it within the full prompt.
+PROMPT_PREFIX = (
+    "<|begin_of_text|>\n"
+    "<|start_header_id|>system<|end_header_id|>\n"
+    "You are a helpful AI assistant. Do not make up any information. Provide a concise answer.\n\n"
+    "<|eot_id|>\n"
+    "<|start_header_id|>user<|end_header_id|>\n"
+)
+CONTEXT_PROMPT_PREFIX = (
+    "<|begin_of_text|>\n"
+    "<|start_header_id|>system<|end_header_id|>\n"
+    "You are a helpful AI assistant. "
+    "Provide one Answer ONLY based on the context provided below. "
+    "Do not generate or answer any other questions. "
+    "Do not make up or infer any information that is not directly stated in the context. "
+    "Provide a concise answer.  context:\n\n"
+)
+RESPONSE_TEST_PROMPT_PREFIX = (
+    "<|begin_of_text|>\n"
+    "<|start_header_id|>system<|end_header_id|>\n"
+    "Determine if the following text contains an answer to the question. Respond with \"Yes\" or \"No\".\n"
+    "<|start_header_id|>user<|end_header_id|>\n"
+)
+
+
+def get_stop_token_ids(tokenizer) -> List[int]:
+    """
+    Get the token IDs that end a reply.
+
+    Llama 3 Instruct closes each chat turn with `<|eot_id|>` rather than with its `<|end_of_text|>` EOS token,
+    so generation has to stop on either one.
+
+    Args:
+        tokenizer: The Llama tokenizer.
+
+    Returns:
+        List[int]: The EOS and end-of-turn token IDs.
+    """
+    stop_token_ids = [tokenizer.eos_token_id]
+    eot_token_id = tokenizer.convert_tokens_to_ids("<|eot_id|>")
+    if eot_token_id is not None and eot_token_id != tokenizer.unk_token_id and eot_token_id not in stop_token_ids:
+        stop_token_ids.append(eot_token_id)
+    return stop_token_ids
+
+
+def is_torch_compile_enabled() -> bool:
+    """
+    Decide whether the decode step is compiled, as selected by LLAMA_TORCH_COMPILE.
+
+    "auto" compiles on CUDA when Triton is installed, the weights are not quantized with bitsandbytes (whose
+    kernels do not compile into a single graph) and greedy decoding uses the default cache, which is the only
+    configuration that decodes with a StaticCache. The default LLAMA_QUANTIZATION is "nf4", so by default
+    nothing is compiled; set LLAMA_QUANTIZATION=none to decode with CUDA graphs when the weights fit in bf16.
+
+    Returns:
+        bool: True if the decode step is compiled.
+    """
+    if LLAMA_TORCH_COMPILE == "auto":
+        return (
+            torch.cuda.is_available()
+            and importlib.util.find_spec("triton") is not None
+            and LLAMA_QUANTIZATION == "none"
+            and LLAMA_NUM_BEAMS == 1
+            and not LLAMA_ASSISTANT_MODEL_ID
+            and not LLAMA_KV_CACHE_BITS
+        )
+    return LLAMA_TORCH_COMPILE == "1"
+
+
+class BeamSharedPrefixCache(DynamicCache):
+    """
+    A key/value cache for beam search that stores the prompt once per sequence instead of once per beam.
+
+    Beam search expands every prompt to `num_beams` identical rows before the first forward pass, so the
+    prompt-phase key/value states are kept as `[batch, heads, prompt_len, head_dim]` and only the tokens
+    generated afterwards are stored per beam. Beam reordering never crosses sequences, so it only has to
+    touch the generated part of the cache. Calling `prefill()` before `generate()` also computes the prompt
+    once per sequence rather than once per beam.
+
+    The saving is in the memory held by the cache and in the reordering, not in the bytes copied per step:
+    like DynamicCache, every `update()` concatenates the prompt states with the generated ones, which
+    materializes the full per-beam key/values of each layer. With more than one sequence, broadcasting the
+    prompt to the beams is a copy as well.
+
+    This overrides `DynamicCache` internals (`key_cache`/`value_cache`, `_seen_tokens` and the
+    `reorder_cache()` hook used by beam search) as of transformers 4.47, which requirements.txt pins.
+    """
+
+    def __init__(self, num_beams: int):
+        """
+        Initialize an empty cache.
+
+        Args:
+            num_beams (int): The number of beams used by `generate()`.
+        """
+        super().__init__()
+        self.num_beams = num_beams
+        self.prefix_key_cache: List[torch.Tensor] = []
+        self.prefix_value_cache: List[torch.Tensor] = []
+        self.prefilling = False
+
+    def prefill(self, model, input_ids: torch.Tensor, attention_mask: torch.Tensor):
+        """
+        Compute the prompt key/values with a single forward pass over the unexpanded batch.
+
+        The last prompt token is left to `generate()`, which needs at least one uncached input token; it then
+        only runs that token for every beam instead of the whole prompt.
+
+        Args:
+            model: The causal language model.
+            input_ids (torch.Tensor): The left-padded prompts, one row per sequence.
+            attention_mask (torch.Tensor): The attention mask of the prompts.
+        """
+        if input_ids.shape[1] < 2:
+            return
+
+        # Position IDs must skip the left padding, as `generate()` does
+        position_ids = (attention_mask.cumsum(dim=-1) - 1).clamp(min=0)
+        self.prefilling = True
+        try:
+            model(
+                input_ids=input_ids[:, :-1],
+                attention_mask=attention_mask[:, :-1],
+                position_ids=position_ids[:, :-1],
+                past_key_values=self,
+                use_cache=True,
+                num_logits_to_keep=1,                   # The logits are not needed; skip the full vocabulary projection
+            )
+        finally:
+            self.prefilling = False
+
+    @staticmethod
+    def _expand_prefix(prefix: torch.Tensor, batch_size: int) -> torch.Tensor:
+        """
+        Broadcast the shared prompt states to every beam.
+
+        Args:
+            prefix (torch.Tensor): Prompt states of shape `[batch, heads, prompt_len, head_dim]`.
+            batch_size (int): The number of rows (sequences times beams) to expand to.
+
+        Returns:
+            torch.Tensor: Prompt states of shape `[batch_size, heads, prompt_len, head_dim]`.
+        """
+        if prefix.shape[0] == 1:
+            return prefix.expand(batch_size, -1, -1, -1)    # A view; update() copies it into the concatenation
+        return prefix.repeat_interleave(batch_size // prefix.shape[0], dim=0)     # A copy per beam
+
+    def update(self, key_states: torch.Tensor, value_states: torch.Tensor, layer_idx: int, cache_kwargs=None) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Store the new key/value states for a layer and return the full states to attend to.
+
+        The first call per layer is the prompt phase: one copy per sequence is kept as the shared prefix.
+        Later calls append the generated tokens to the per-beam part of the cache.
+        """
+        if layer_idx == 0:
+            self._seen_tokens += key_states.shape[-2]
+
+        if len(self.prefix_key_cache) <= layer_idx:
+            # Rows belonging to the same sequence are identical during the prompt phase, unless the prompt is
+            # prefilled before being expanded to the beams
+            rows = slice(None) if self.prefilling else slice(None, None, self.num_beams)
+            self.prefix_key_cache.append(key_states[rows].clone())
+            self.prefix_value_cache.append(value_states[rows].clone())
+            self.key_cache.append(key_states[:, :, :0])
+            self.value_cache.append(value_states[:, :, :0])
+            return key_states, value_states
+
+        if self.key_cache[layer_idx].shape[-2] == 0:
+            # The first per-beam states; a prefilled cache holds no rows per beam yet
+            self.key_cache[layer_idx] = key_states
+            self.value_cache[layer_idx] = value_states
+        else:
+            self.key_cache[layer_idx] = torch.cat([self.key_cache[layer_idx], key_states], dim=-2)
+            self.value_cache[layer_idx] = torch.cat([self.value_cache[layer_idx], value_states], dim=-2)
+
+        batch_size = key_states.shape[0]
+        return (
+            torch.cat([self._expand_prefix(self.prefix_key_cache[layer_idx], batch_size), self.key_cache[layer_idx]], dim=-2),
+            torch.cat([self._expand_prefix(self.prefix_value_cache[layer_idx], batch_size), self.value_cache[layer_idx]], dim=-2),
+        )
+
+    def get_seq_length(self, layer_idx: Optional[int] = 0) -> int:
+        """
+        Return the number of cached positions (prompt plus generated tokens) for a layer.
+        """
+        if len(self.prefix_key_cache) <= layer_idx:
+            return 0
+        return self.prefix_key_cache[layer_idx].shape[-2] + self.key_cache[layer_idx].shape[-2]
+
+    def reorder_cache(self, beam_idx: torch.LongTensor):
+        """
+        Reorder the generated part of the cache for the selected beams; the shared prompt part is unaffected.
+        """
+        for layer_idx in range(len(self.key_cache)):
+            device = self.key_cache[layer_idx].device
+            self.key_cache[layer_idx] = self.key_cache[layer_idx].index_select(0, beam_idx.to(device))
+            self.value_cache[layer_idx] = self.value_cache[layer_idx].index_select(0, beam_idx.to(device))
+
+
+class DeviceNoRepeatNGramLogitsProcessor(LogitsProcessor):
+    """
+    Ban tokens that would repeat an n-gram, computed with tensor operations on the scores' device.
+
+    Produces the same bans as transformers' `no_repeat_ngram_size`, whose implementation copies every
+    hypothesis to the CPU and rebuilds a Python dictionary of n-grams at each decoding step. Here every
+    window of `ngram_size - 1` tokens is compared with the last `ngram_size - 1` tokens in one batched
+    comparison, and the tokens that followed the matching windows are masked out.
+    """
+
+    def __init__(self, ngram_size: int):
+        """
+        Args:
+            ngram_size (int): The size of the n-grams that may only occur once.
+        """
+        self.ngram_size = ngram_size
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
+        seq_len = input_ids.shape[1]
+        if seq_len < self.ngram_size:                   # No complete n-gram to repeat yet
+            return scores
+
+        if self.ngram_size == 1:
+            followers = input_ids
+            matches = torch.ones_like(input_ids, dtype=torch.bool)
+        else:
+            windows = input_ids[:, :-1].unfold(1, self.ngram_size - 1, 1)     # [batch, seq_len - n + 1, n - 1]
+            last_tokens = input_ids[:, seq_len - self.ngram_size + 1:]          # [batch, n - 1]
+            matches = (windows == last_tokens[:, None, :]).all(dim=-1)          # [batch, seq_len - n + 1]
+            followers = input_ids[:, self.ngram_size - 1:]                      # Token that followed each window
+
+        # Scatter into an extra column for non-matching windows so that duplicate indices always write True
+        vocab_size = scores.shape[-1]
+        banned = torch.zeros((scores.shape[0], vocab_size + 1), dtype=torch.bool, device=scores.device)
+        banned.scatter_(1, followers.masked_fill(~matches, vocab_size), True)
+        return scores.masked_fill(banned[:, :vocab_size], -float("inf"))
+
+
+class CallbackTextStreamer(TextStreamer):
+    """
+    A streamer that hands each finished piece of decoded text to a callback instead of printing it.
+
+    It is called by `generate()` on the generating thread, so streaming needs no thread of its own.
+    """
+
+    def __init__(self, tokenizer, on_text: Callable[[str], None], skip_prompt: bool = False, **decode_kwargs):
+        """
+        Args:
+            tokenizer: The tokenizer that decodes the generated tokens.
+            on_text (Callable[[str], None]): Called with each new piece of text.
+            skip_prompt (bool): Whether to skip the prompt tokens `generate()` passes first.
+            **decode_kwargs: Passed on to `tokenizer.decode()`.
+        """
+        super().__init__(tokenizer, skip_prompt, **decode_kwargs)
+        self.on_text = on_text
+
+    def on_finalized_text(self, text: str, stream_end: bool = False):
+        if text:
+            self.on_text(text)
+
 
 class LlamaService:
     """
@@ -17,15 +304,101 @@ class LlamaService:
         """
         Initialize the LlamaService by loading the pre-trained model and tokenizer.
         """
-        # Load the pre-trained Llama 3.2 3B Instruct model
-        self.model = AutoModelForCausalLM.from_pretrained(
-            "meta-llama/Llama-3.2-3B-Instruct",             # Model identifier on Hugging Face Hub
-            device_map="auto",                              # Automatically distribute the model across available GPUs
-            torch_dtype=torch.float16,                      # Use half-precision for better performance
+        # Load the pre-trained Llama 3.2 3B Instruct model and its tokenizer. Both are shared by every
+        # service in the process, so the weights are only held in GPU memory once.
+        self.model = get_model()
+        self.tokenizer = get_tokenizer()
+
+        # Bound the prompt and reply lengths. The KV cache grows with every token, so the limits are kept well
+        # below the model's context window, and a prompt plus its reply never exceeds the position embeddings.
+        self.max_new_tokens = LLAMA_MAX_NEW_TOKENS
+        self.max_input_tokens = min(
+            LLAMA_MAX_INPUT_TOKENS,
+            self.model.config.max_position_embeddings - self.max_new_tokens,
         )
 
-        # Load the tokenizer associated with the Llama 3.2 3B Instruct model
-        self.tokenizer = AutoTokenizer.from_pretrained("meta-llama/Llama-3.2-3B-Instruct")
+        # Prompt batches are padded up to a multiple of a fixed length, so the prefill only ever sees a small set
+        # of input shapes and kernel selections are reused across requests. The input limit is rounded down so a
+        # padded prompt still fits it.
+        self.pad_to_multiple_of = LLAMA_PAD_TO_MULTIPLE_OF or None
+        if self.pad_to_multiple_of:
+            self.max_input_tokens -= self.max_input_tokens % self.pad_to_multiple_of
+
+        # Tokenize the constant prompt prefixes once; requests then only tokenize the text that follows them
+        self.prompt_prefix_ids = {
+            prefix: self.tokenizer(prefix, add_special_tokens=False).input_ids
+            for prefix in (PROMPT_PREFIX, CONTEXT_PROMPT_PREFIX, RESPONSE_TEST_PROMPT_PREFIX)
+        }
+
+        # Token IDs of the two possible answers to the response test prompt
+        self.yes_token_id = self.tokenizer.encode(" Yes", add_special_tokens=False)[0]
+        self.no_token_id = self.tokenizer.encode(" No", add_special_tokens=False)[0]
+
+        # Stop at the end of the assistant's turn, not only at the end of the text
+        self.stop_token_ids = get_stop_token_ids(self.tokenizer)
+
+        # Optionally sample replies with nucleus (top-p) sampling instead of decoding greedily
+        self.sampling_kwargs = {"temperature": LLAMA_TEMPERATURE, "top_p": LLAMA_TOP_P} if LLAMA_TEMPERATURE > 0 else {}
+
+        # Optionally discourage repetition. A repetition penalty is a single gather and scatter over the logits per
+        # step; banning repeated n-grams is done on the GPU rather than with transformers' per-step Python scan.
+        # Both are off by default: greedy decoding with a capped reply length does not need them.
+        self.logits_processor = LogitsProcessorList()
+        if LLAMA_REPETITION_PENALTY != 1.0:
+            self.logits_processor.append(RepetitionPenaltyLogitsProcessor(LLAMA_REPETITION_PENALTY))
+        if LLAMA_NO_REPEAT_NGRAM_SIZE > 0:
+            self.logits_processor.append(DeviceNoRepeatNGramLogitsProcessor(LLAMA_NO_REPEAT_NGRAM_SIZE))
+
+        # Optionally load a small draft model sharing the Llama 3 vocabulary. When present, greedy decoding
+        # is accelerated with speculative (assisted) generation without changing the generated text.
+        self.assistant_model = None
+        if LLAMA_ASSISTANT_MODEL_ID:
+            self.assistant_model = get_model(LLAMA_ASSISTANT_MODEL_ID, quantize=False)
+            logging.info(f"Speculative decoding enabled with draft model: {LLAMA_ASSISTANT_MODEL_ID}")
+
+        # Optionally decode with CUDA graphs. Whenever `generate()` decodes with a StaticCache on CUDA, it compiles
+        # the one-token decode step with torch.compile in "reduce-overhead" mode, which records the step's kernels
+        # into a CUDA graph and replays it with a single launch per token. The prefill stays eager, since its
+        # length changes with every prompt. The warm-up runs three decode steps, so compilation and graph capture
+        # happen before the first request rather than during it.
+        # The StaticCaches are allocated per batch size and reused across requests, keeping at most
+        # LLAMA_STATIC_CACHE_ROWS rows in total (see get_static_cache).
+        self.static_caches: "OrderedDict[int, StaticCache]" = OrderedDict()
+        self.torch_compile = is_torch_compile_enabled()
+        if self.torch_compile:
+            self.model.generate(
+                torch.zeros((1, 16), dtype=torch.long, device=self.model.device),
+                attention_mask=torch.ones((1, 16), dtype=torch.long, device=self.model.device),
+                max_new_tokens=4,
+                min_new_tokens=4,                       # Don't let an early EOS cut the warm-up short
+                pad_token_id=self.tokenizer.eos_token_id,
+                past_key_values=self.get_static_cache(1),
+            )
+            logging.info("Llama decode step compiled and captured as a CUDA graph.")
+
+        # Optionally pre-compute the key/values of the constant generation prompt prefixes (see build_prefix_caches)
+        self.prefix_caches: Dict[Tuple[int, ...], DynamicCache] = {}
+        if (LLAMA_PREFIX_CACHE and LLAMA_NUM_BEAMS == 1 and self.assistant_model is None and not LLAMA_KV_CACHE_BITS
+                and not self.torch_compile):
+            self.build_prefix_caches()
+
+    def build_prefix_caches(self):
+        """
+        Pre-compute the key/values of the constant generation prompt prefixes.
+
+        A single prompt decoded with the default dynamic cache then starts from a copy of its prefix's
+        key/values and only prefills the rest. Enabled with LLAMA_PREFIX_CACHE=1.
+        """
+        for prefix in (PROMPT_PREFIX, CONTEXT_PROMPT_PREFIX):
+            prefix_ids = self.prompt_prefix_ids[prefix]
+            prefix_cache = DynamicCache()
+            with torch.inference_mode():
+                self.model(
+                    torch.tensor([prefix_ids], device=self.model.device),
+                    past_key_values=prefix_cache,
+                    use_cache=True,
+                )
+            self.prefix_caches[tuple(prefix_ids)] = prefix_cache
 
     def create_prompt_for_llama(self, query: str) -> str:
         """
@@ -38,11 +411,7 @@ class LlamaService:
             str: A formatted prompt for the model.
         """
         system_prompt = (
-            "<|begin_of_text|>\n"
-            "<|start_header_id|>system<|end_header_id|>\n"
-            "You are a helpful AI assistant. Do not make up any information. Provide a concise answer.\n\n"
-            "<|eot_id|>\n"
-            f"<|start_header_id|>user<|end_header_id|>\n"
+            f"{PROMPT_PREFIX}"
             f"{query}\n"
             "<|eot_id|>\n"
             "<|start_header_id|>assistant<|end_header_id|>"
@@ -61,13 +430,7 @@ class LlamaService:
             str: A formatted prompt for the model.
         """
         system_prompt = (
-            "<|begin_of_text|>\n"
-            "<|start_header_id|>system<|end_header_id|>\n"
-            "You are a helpful AI assistant. "
-            "Provide one Answer ONLY based on the context provided below. "
-            "Do not generate or answer any other questions. "
-            "Do not make up or infer any information that is not directly stated in the context. "
-            f"Provide a concise answer.  context:\n\n"
+            f"{CONTEXT_PROMPT_PREFIX}"
             f"{context_information}"
             "<|eot_id|>\n"
             f"<|start_header_id|>user<|end_header_id|>\n"
@@ -81,6 +444,8 @@ class LlamaService:
         """
         Create a prompt to test if the provided text contains an answer to the query.
 
+        The prompt ends right before the answer, so the model's next token is expected to be " Yes" or " No".
+
         Args:
             query (str): The user's query.
             text_to_check (str): The text to evaluate.
@@ -89,14 +454,11 @@ class LlamaService:
             str: A formatted prompt for the model.
         """
         system_prompt = (
-            "<|begin_of_text|>\n"
-            "<|start_header_id|>system<|end_header_id|>\n"
-            "Determine if the following text contains an answer to the question. Respond with \"Yes\" or \"No\".\n"
-            "<|start_header_id|>user<|end_header_id|>\n"
+            f"{RESPONSE_TEST_PROMPT_PREFIX}"
             f"Question: {query}\n"
             f"Text: {text_to_check}\n"
             "<|start_header_id|>assistant<|end_header_id|>\n"
-            "Answer: <|end_of_text|>\n"
+            "Answer:"
         )
         return system_prompt
 
@@ -122,6 +484,304 @@ class LlamaService:
 
         return llama_output
 
+    def encode_prompts(self, input_texts: List[str], max_length: Optional[int] = None) -> List[List[int]]:
+        """
+        Tokenize a batch of prompts, reusing the cached token IDs of their constant prefixes.
+
+        The prompts already contain the `<|begin_of_text|>` token, so no special tokens are added. The text
+        following the prefixes is tokenized in a single call, which the fast (Rust) tokenizer spreads over
+        several threads. Prompts longer than `max_length` lose tokens from the start of the text that follows
+        the prefix (the context, for context prompts), so the instructions and the closing assistant header are kept.
+
+        Args:
+            input_texts (List[str]): The input prompts for the model.
+            max_length (Optional[int]): The maximum number of tokens; None disables truncation.
+
+        Returns:
+            List[List[int]]: The token IDs of each prompt.
+        """
+        prefixes_ids = []
+        bodies = []
+        for input_text in input_texts:
+            prefix_ids = []
+            for prefix, ids in self.prompt_prefix_ids.items():
+                if input_text.startswith(prefix):
+                    prefix_ids = ids
+                    input_text = input_text[len(prefix):]
+                    break
+            prefixes_ids.append(prefix_ids)
+            bodies.append(input_text)
+
+        input_ids = []
+        for prefix_ids, body_ids in zip(prefixes_ids, self.tokenizer(bodies, add_special_tokens=False).input_ids):
+            if max_length is not None and len(prefix_ids) + len(body_ids) > max_length:
+                body_ids = body_ids[len(body_ids) - max(0, max_length - len(prefix_ids)):]
+            input_ids.append(prefix_ids + body_ids)
+        return input_ids
+
+    def encode_prompt(self, input_text: str, max_length: Optional[int] = None) -> List[int]:
+        """
+        Tokenize a prompt, reusing the cached token IDs of its constant prefix when it has one.
+
+        Args:
+            input_text (str): The input prompt for the model.
+            max_length (Optional[int]): The maximum number of tokens; None disables truncation.
+
+        Returns:
+            List[int]: The token IDs of the prompt.
+        """
+        return self.encode_prompts([input_text], max_length)[0]
+
+    def encode_context_prompts(self, queries: List[str], contexts: List[str], max_length: Optional[int] = None) -> List[List[int]]:
+        """
+        Tokenize a batch of context-restricted prompts, fitting each context into the token budget.
+
+        Only the contexts and the rest of each prompt (the query and the chat headers) are tokenized, in a single
+        call; the constant prefix reuses its cached token IDs. The context and the rest meet at an `<|eot_id|>`
+        special token, where the tokenizer always splits, so the tokens are the same as for the whole prompt.
+        A context that does not fit loses its end: the search results are ordered by relevance, so the least
+        relevant text is dropped first, while the instructions, the query and the assistant header are kept.
+
+        Args:
+            queries (List[str]): The users' queries.
+            contexts (List[str]): Contextual information to restrict each response.
+            max_length (Optional[int]): The maximum number of tokens; None disables truncation.
+
+        Returns:
+            List[List[int]]: The token IDs of each prompt.
+        """
+        prefix_ids = self.prompt_prefix_ids[CONTEXT_PROMPT_PREFIX]
+        rests = [
+            self.create_prompt_restricted_to_context_info_for_llama(query, "")[len(CONTEXT_PROMPT_PREFIX):]
+            for query in queries
+        ]
+        encodings = self.tokenizer(list(contexts) + rests, add_special_tokens=False).input_ids
+
+        input_ids = []
+        for context_ids, rest_ids in zip(encodings[:len(contexts)], encodings[len(contexts):]):
+            if max_length is not None:
+                budget = max_length - len(prefix_ids) - len(rest_ids)
+                if budget >= 0:
+                    context_ids = context_ids[:budget]
+                else:
+                    # The query alone is too long; keep its end with the assistant header, as encode_prompts() does
+                    context_ids = []
+                    rest_ids = rest_ids[len(rest_ids) - max(0, max_length - len(prefix_ids)):]
+            input_ids.append(prefix_ids + context_ids + rest_ids)
+        return input_ids
+
+    def resolve_max_new_tokens(self, max_new_tokens: Optional[int] = None) -> int:
+        """
+        Get the number of tokens to generate for a request, capped at the configured maximum.
+
+        Args:
+            max_new_tokens (Optional[int]): The number of tokens requested; None uses the configured maximum.
+
+        Returns:
+            int: The number of tokens to generate.
+        """
+        if max_new_tokens is None:
+            return self.max_new_tokens
+        return max(1, min(max_new_tokens, self.max_new_tokens))
+
+    def get_static_cache(self, batch_size: int) -> StaticCache:
+        """
+        Return the pre-allocated StaticCache for a batch size, cleared for a new `generate()` call.
+
+        Each cache is sized for the longest prompt plus the longest reply, and then reused. Decoding therefore
+        never grows the key/value tensors, and every call with the same batch size has the same tensor shapes,
+        so the captured CUDA graph of the decode step is replayed rather than re-recorded.
+
+        A full-length cache row takes hundreds of megabytes, so the caches kept for different batch sizes hold
+        at most LLAMA_STATIC_CACHE_ROWS rows together. The least recently used caches are freed to make room.
+
+        Args:
+            batch_size (int): The number of sequences decoded together.
+
+        Returns:
+            StaticCache: The cache for this batch size.
+        """
+        static_cache = self.static_caches.get(batch_size)
+        if static_cache is None:
+            while self.static_caches and sum(self.static_caches) + batch_size > LLAMA_STATIC_CACHE_ROWS:
+                self.static_caches.popitem(last=False)  # Free the key/value tensors before allocating new ones
+            static_cache = StaticCache(
+                self.model.config,
+                max_batch_size=batch_size,
+                max_cache_len=self.max_input_tokens + self.max_new_tokens,
+                device=self.model.device,
+                dtype=select_compute_dtype(),           # Same dtype as the key/value states written into it
+            )
+            self.static_caches[batch_size] = static_cache
+        else:
+            self.static_caches.move_to_end(batch_size)
+            static_cache.reset()
+        return static_cache
+
+    def get_prefix_cache(self, input_ids: List[int]) -> Optional[DynamicCache]:
+        """
+        Return a copy of the pre-computed key/values of the prompt's constant prefix.
+
+        The copy is extended by `generate()`, so the pre-computed cache itself is never modified.
+
+        Args:
+            input_ids (List[int]): The token IDs of the prompt, without padding.
+
+        Returns:
+            Optional[DynamicCache]: The prefix key/values, or None if the prompt has no pre-computed prefix.
+        """
+        for prefix_ids, prefix_cache in self.prefix_caches.items():
+            if len(input_ids) > len(prefix_ids) and tuple(input_ids[:len(prefix_ids)]) == prefix_ids:
+                with torch.inference_mode():
+                    return copy.deepcopy(prefix_cache)
+        return None
+
+    def _decoding_strategy_kwargs(self, input_ids: List[List[int]], inputs: Dict[str, torch.Tensor]) -> dict:
+        """
+        Select the decoding strategy and key/value cache for `generate()`.
+
+        Args:
+            input_ids (List[List[int]]): The token IDs of each prompt decoded together, without padding.
+            inputs (Dict[str, torch.Tensor]): The padded `input_ids` and `attention_mask` on the model's device.
+
+        Returns:
+            dict: Keyword arguments for `generate()`.
+        """
+        # Beam search computes the prompt once per sequence and shares its key/values across beams
+        if LLAMA_NUM_BEAMS > 1:
+            beam_cache = BeamSharedPrefixCache(LLAMA_NUM_BEAMS)
+            beam_cache.prefill(self.model, inputs["input_ids"], inputs["attention_mask"])
+            return {
+                "num_beams": LLAMA_NUM_BEAMS,
+                "early_stopping": True,
+                "past_key_values": beam_cache,
+            }
+
+        # Greedy decoding, accelerated by the draft model when one is configured
+        strategy_kwargs = {
+            "num_beams": 1,
+            "assistant_model": self.assistant_model,
+        }
+        if self.assistant_model is None:
+            if LLAMA_KV_CACHE_BITS:
+                # Quantize the KV cache so each decoding step reads fewer bytes for attention
+                strategy_kwargs["cache_implementation"] = "quantized"
+                strategy_kwargs["cache_config"] = QuantizedCacheConfig(backend="quanto", nbits=LLAMA_KV_CACHE_BITS)
+            elif self.torch_compile:
+                # Fixed-shape cache so the compiled decode step is not retraced as the sequence grows
+                strategy_kwargs["past_key_values"] = self.get_static_cache(len(input_ids))
+            elif len(input_ids) == 1:
+                # Skip prefilling the constant prompt prefix. Batches are left-padded, which shifts the prefix
+                # by a different amount in every row, so its key/values are only reused for a single prompt.
+                prefix_cache = self.get_prefix_cache(input_ids[0])
+                if prefix_cache is not None:
+                    strategy_kwargs["past_key_values"] = prefix_cache
+        return strategy_kwargs
+
+    def submit_prompts_to_llama(self, input_texts: List[str], max_new_tokens: Optional[int] = None) -> List[str]:
+        """
+        Generate text for a batch of prompts.
+
+        Args:
+            input_texts (List[str]): The input prompts for the model.
+            max_new_tokens (Optional[int]): The maximum number of tokens to generate; None uses LLAMA_MAX_NEW_TOKENS.
+
+        Returns:
+            List[str]: The generated text for each prompt, in order.
+        """
+        # Tokenize the input texts, truncating them to the maximum number of input tokens
+        input_ids = self.encode_prompts(input_texts, self.max_input_tokens)
+        return self.submit_token_prompts_to_llama(input_ids, max_new_tokens)
+
+    def submit_token_prompts_to_llama(self, input_ids: List[List[int]], max_new_tokens: Optional[int] = None,
+                                      streamer: Optional[TextStreamer] = None) -> List[str]:
+        """
+        Generate text for a batch of tokenized prompts with a single `generate()` call.
+
+        Decoding at batch size 1 is bound by reading the weights from GPU memory; decoding several prompts
+        together reuses every weight read across the whole batch.
+
+        Args:
+            input_ids (List[List[int]]): The token IDs of each prompt, within the maximum number of input tokens.
+            max_new_tokens (Optional[int]): The maximum number of tokens to generate; None uses LLAMA_MAX_NEW_TOKENS.
+            streamer (Optional[TextStreamer]): Receives the tokens of a single prompt as they are generated.
+
+        Returns:
+            List[str]: The generated text for each prompt, in order.
+        """
+        # Left-pad the batch to a common length. A single prompt is not padded, which keeps its positions aligned
+        # with the pre-computed key/values of its prefix.
+        inputs = self.tokenizer.pad(
+            {"input_ids": input_ids},                   # The token IDs of each prompt
+            padding=True,                               # Pad the batch to its longest prompt
+            pad_to_multiple_of=self.pad_to_multiple_of if len(input_ids) > 1 else None,  # Round the padded length up to a length bucket
+            return_tensors="pt",                        # Return PyTorch tensors
+        )
+        inputs = copy_to_device(inputs, self.model.device)  # Move the tokenized inputs to the GPU
+
+        # Generate text using the model, without autograd bookkeeping
+        with torch.inference_mode():
+            outputs = self.model.generate(
+                inputs["input_ids"],                        # Token IDs of the input prompts
+                attention_mask=inputs["attention_mask"],    # Attention mask for the input tokens (excludes padding)
+                max_new_tokens=self.resolve_max_new_tokens(max_new_tokens),     # Maximum number of new tokens to generate
+                eos_token_id=self.stop_token_ids,           # Stop at <|eot_id|> as well as at EOS
+                pad_token_id=self.tokenizer.pad_token_id,   # Pad finished sequences while the rest of the batch decodes
+                logits_processor=self.logits_processor,     # Optionally discourage the model from repeating itself
+                do_sample=LLAMA_TEMPERATURE > 0,            # Deterministic output unless a sampling temperature is set
+                **self.sampling_kwargs,                     # Temperature and top-p, when sampling
+                use_cache=True,                             # Reuse past key/values between decoding steps
+                streamer=streamer,                          # Optionally hand out the tokens as they are generated
+                **self._decoding_strategy_kwargs(input_ids, inputs),    # Beam search or greedy/speculative decoding
+            )
+
+        # Decode only the generated token IDs; the prompts and padding all end at the same position
+        input_length = inputs["input_ids"].shape[1]
+        replies = self.tokenizer.batch_decode(outputs[:, input_length:], skip_special_tokens=True)
+        return [reply.strip() for reply in replies]
+
+    def stream_token_prompt_to_llama(self, input_ids: List[int], on_text: Callable[[str], None],
+                                     max_new_tokens: Optional[int] = None) -> str:
+        """
+        Generate text for a tokenized prompt, handing it out in pieces as it is decoded.
+
+        `generate()` runs on the calling thread and passes every new token to a CallbackTextStreamer, which
+        decodes the tokens incrementally and calls `on_text` with each finished piece. Beam search only knows
+        its best sequence at the end, so with beams the whole reply is handed out at once.
+
+        Args:
+            input_ids (List[int]): The token IDs of the prompt.
+            on_text (Callable[[str], None]): Called with each new piece of the generated text.
+            max_new_tokens (Optional[int]): The maximum number of tokens to generate; None uses LLAMA_MAX_NEW_TOKENS.
+
+        Returns:
+            str: The complete generated text.
+        """
+        if LLAMA_NUM_BEAMS > 1:
+            reply = self.submit_token_prompts_to_llama([input_ids], max_new_tokens)[0]
+            on_text(reply)
+            return reply
+
+        streamer = CallbackTextStreamer(self.tokenizer, on_text, skip_prompt=True, skip_special_tokens=True)
+        return self.submit_token_prompts_to_llama([input_ids], max_new_tokens, streamer=streamer)[0]
+
+    def stream_query_with_context_to_llama(self, query: str, context: str, on_text: Callable[[str], None],
+                                           max_new_tokens: Optional[int] = None) -> str:
+        """
+        Submit a query to the Llama model with additional context, handing out the response as it is generated.
+
+        Args:
+            query (str): The user's query.
+            context (str): Contextual information to restrict the model's response.
+            on_text (Callable[[str], None]): Called with each new piece of the response.
+            max_new_tokens (Optional[int]): The maximum number of tokens of the response; None uses LLAMA_MAX_NEW_TOKENS.
+
+        Returns:
+            str: The model's complete response.
+        """
+        input_ids = self.encode_context_prompts([query], [context], self.max_input_tokens)[0]
+        return self.stream_token_prompt_to_llama(input_ids, on_text, max_new_tokens)
+
     def submit_prompt_to_llama(self, input_text: str) -> str:
         """
         Generate text using the Llama 3.2 3B model.
@@ -132,29 +792,21 @@ class LlamaService:
         Returns:
             str: The generated text.
         """
-        # Tokenize the input text
-        inputs = self.tokenizer(
-            input_text,                                 # The input text to tokenize
-            return_tensors="pt",                        # Return PyTorch tensors
-            truncation=True,                            # Enable truncation if the input exceeds the max_length
-            max_length=32000,                           # Set the maximum number of tokens for the input
-            truncation_strategy="longest_first",        # Truncate the longest part of the input if necessary
-        ).to("cuda")                                    # Move the tokenized inputs to the GPU
-
-        # Generate text using the model
-        outputs = self.model.generate(
-            inputs["input_ids"],                        # Token IDs of the input prompt
-            attention_mask=inputs["attention_mask"],    # Attention mask for the input tokens
-            max_new_tokens=64000,                       # Maximum number of new tokens to generate
-            pad_token_id=self.tokenizer.eos_token_id,   # Use the EOS token as the padding token
-            no_repeat_ngram_size=2,                     # Prevent the model from repeating 2-grams
-            num_beams=5,                                # Use beam search with 5 beams
-            early_stopping=True,                        # Stop generation early if all beam candidates reach the EOS token
-        )
-
-        # Decode the generated token IDs back into text
-        reply_from_llama = self.tokenizer.decode(outputs[0], skip_special_tokens=False)
-        return self.format_output_from_llama(reply_from_llama)
+        return self.submit_prompts_to_llama([input_text])[0]
+
+    def submit_queries_without_context_to_llama(self, queries: List[str], max_new_tokens: Optional[int] = None) -> List[str]:
+        """
+        Submit a batch of queries to the Llama model without additional context.
+
+        Args:
+            queries (List[str]): The users' queries.
+            max_new_tokens (Optional[int]): The maximum number of tokens per response; None uses LLAMA_MAX_NEW_TOKENS.
+
+        Returns:
+            List[str]: The model's response to each query.
+        """
+        prompts_for_llama = [self.create_prompt_for_llama(query) for query in queries]
+        return self.submit_prompts_to_llama(prompts_for_llama, max_new_tokens)
 
     def submit_query_without_context_to_llama(self, query: str) -> str:
         """
@@ -166,8 +818,23 @@ class LlamaService:
         Returns:
             str: The model's response.
         """
-        prompt_for_llama = self.create_prompt_for_llama(query)
-        return self.submit_prompt_to_llama(prompt_for_llama)
+        return self.submit_queries_without_context_to_llama([query])[0]
+
+    def submit_queries_with_context_to_llama(self, queries: List[str], contexts: List[str],
+                                             max_new_tokens: Optional[int] = None) -> List[str]:
+        """
+        Submit a batch of queries to the Llama model, each with its own additional context.
+
+        Args:
+            queries (List[str]): The users' queries.
+            contexts (List[str]): Contextual information to restrict each response.
+            max_new_tokens (Optional[int]): The maximum number of tokens per response; None uses LLAMA_MAX_NEW_TOKENS.
+
+        Returns:
+            List[str]: The model's response to each query.
+        """
+        input_ids = self.encode_context_prompts(queries, contexts, self.max_input_tokens)
+        return self.submit_token_prompts_to_llama(input_ids, max_new_tokens)
 
     def submit_query_with_context_to_llama(self, query: str, context: str) -> str:
         """
@@ -180,10 +847,46 @@ class LlamaService:
         Returns:
             str: The model's response.
         """
-        prompt_for_llama = self.create_prompt_restricted_to_context_info_for_llama(query, context)
-        return self.submit_prompt_to_llama(prompt_for_llama)
+        return self.submit_queries_with_context_to_llama([query], [context])[0]
 
-    def was_query_likely_answered(self, query: str, reply: str) -> Optional[re.Match]:
+    def were_queries_likely_answered(self, queries: List[str], replies: List[str]) -> List[bool]:
+        """
+        Check, for a batch of queries, whether each reply likely answers its query.
+
+        Rather than generating a free-form verdict, a single forward pass scores the token that follows
+        the response test prompt, and the reply is accepted when " Yes" is more likely than " No".
+
+        Args:
+            queries (List[str]): The users' queries.
+            replies (List[str]): The model's replies.
+
+        Returns:
+            List[bool]: True for each reply that likely answers its query.
+        """
+        input_ids = self.encode_prompts(
+            [self.create_response_test_prompt_for_llama(query, reply) for query, reply in zip(queries, replies)],
+            self.max_input_tokens,
+        )
+        inputs = self.tokenizer.pad(
+            {"input_ids": input_ids}, padding=True, pad_to_multiple_of=self.pad_to_multiple_of, return_tensors="pt"
+        )
+        inputs = copy_to_device(inputs, self.model.device)
+
+        # Position IDs must skip the left padding, as `generate()` does
+        position_ids = (inputs["attention_mask"].cumsum(dim=-1) - 1).clamp(min=0)
+
+        with torch.inference_mode():
+            logits = self.model(
+                input_ids=inputs["input_ids"],
+                attention_mask=inputs["attention_mask"],
+                position_ids=position_ids,
+                use_cache=False,
+                num_logits_to_keep=1,                   # Only compute the logits of the next token
+            ).logits[:, -1, :]
+
+        return (logits[:, self.yes_token_id] > logits[:, self.no_token_id]).tolist()
+
+    def was_query_likely_answered(self, query: str, reply: str) -> bool:
         """
         Check if the provided reply likely answers the query.
 
@@ -192,8 +895,236 @@ class LlamaService:
             reply (str): The model's reply.
 
         Returns:
-            Optional[re.Match]: A match object if the reply contains "Yes", otherwise None.
+            bool: True if the model judged that the reply answers the query.
+        """
+        return self.were_queries_likely_answered([query], [reply])[0]
+
+
+class VllmLlamaService(LlamaService):
+    """
+    A LlamaService backed by the vLLM engine instead of Hugging Face `generate()`.
+
+    vLLM stores the KV cache in fixed-size pages (PagedAttention) and batches concurrent
+    requests continuously, which avoids per-request KV allocations and VRAM fragmentation.
+    """
+
+    def __init__(self):
+        """
+        Initialize the vLLM engine and its tokenizer.
+        """
+        # vLLM is an optional dependency, only required when this backend is selected
+        from vllm import LLM, SamplingParams
+
+        self.llm = LLM(
+            model=LLAMA_MODEL_ID,                           # Model identifier on Hugging Face Hub
+            dtype="auto",                                   # Use the checkpoint's half-precision dtype (BF16, or FP16 where unsupported)
+            max_model_len=8192,                             # Bound the paged KV cache to a realistic context length
+        )
+        self.tokenizer = self.llm.get_tokenizer()
+        self.max_input_tokens = LLAMA_MAX_INPUT_TOKENS
+        self.max_new_tokens = LLAMA_MAX_NEW_TOKENS
+        self.prompt_prefix_ids = {
+            prefix: self.tokenizer(prefix, add_special_tokens=False).input_ids
+            for prefix in (PROMPT_PREFIX, CONTEXT_PROMPT_PREFIX, RESPONSE_TEST_PROMPT_PREFIX)
+        }
+        self.sampling_params = SamplingParams(
+            n=1,                                            # One completion per prompt
+            temperature=LLAMA_TEMPERATURE,                  # Greedy decoding unless a sampling temperature is set
+            top_p=LLAMA_TOP_P if LLAMA_TEMPERATURE > 0 else 1.0,    # Nucleus sampling, when sampling
+            repetition_penalty=LLAMA_REPETITION_PENALTY,    # Optionally discourage repetition
+            max_tokens=self.max_new_tokens,                 # Maximum number of new tokens to generate
+            stop_token_ids=get_stop_token_ids(self.tokenizer),  # Stop at <|eot_id|> as well as at EOS
+        )
+
+        # The response test is answered with a single token restricted to " Yes" or " No"
+        self.yes_token_id = self.tokenizer.encode(" Yes", add_special_tokens=False)[0]
+        self.no_token_id = self.tokenizer.encode(" No", add_special_tokens=False)[0]
+        self.response_test_sampling_params = SamplingParams(
+            n=1,
+            temperature=0.0,
+            max_tokens=1,
+            allowed_token_ids=[self.yes_token_id, self.no_token_id],
+        )
+
+    def were_queries_likely_answered(self, queries: List[str], replies: List[str]) -> List[bool]:
+        """
+        Check, for a batch of queries, whether each reply likely answers its query.
+
+        Args:
+            queries (List[str]): The users' queries.
+            replies (List[str]): The model's replies.
+
+        Returns:
+            List[bool]: True for each reply that likely answers its query.
+        """
+        input_ids = self.encode_prompts(
+            [self.create_response_test_prompt_for_llama(query, reply) for query, reply in zip(queries, replies)],
+            self.max_input_tokens,
+        )
+        prompts = [{"prompt_token_ids": prompt_ids} for prompt_ids in input_ids]
+        outputs = self.llm.generate(prompts, self.response_test_sampling_params, use_tqdm=False)
+        return [output.outputs[0].token_ids[0] == self.yes_token_id for output in outputs]
+
+    def _sampling_params_for(self, max_new_tokens: Optional[int] = None):
+        """
+        Get the sampling parameters for a reply length limit.
+        """
+        if max_new_tokens is None:
+            return self.sampling_params
+        sampling_params = self.sampling_params.clone()
+        sampling_params.max_tokens = self.resolve_max_new_tokens(max_new_tokens)
+        return sampling_params
+
+    def submit_token_prompts_to_llama(self, input_ids: List[List[int]], max_new_tokens: Optional[int] = None) -> List[str]:
+        """
+        Generate text for a batch of tokenized prompts using the vLLM engine.
+
+        The prompts come from the base class's encoding, which already holds `<|begin_of_text|>` once and is
+        truncated to LLAMA_MAX_INPUT_TOKENS, so vLLM neither adds a second BOS nor rejects an overlong context.
+
+        Args:
+            input_ids (List[List[int]]): The token IDs of each prompt.
+            max_new_tokens (Optional[int]): The maximum number of tokens to generate; None uses LLAMA_MAX_NEW_TOKENS.
+
+        Returns:
+            List[str]: The generated text for each prompt, in order.
+        """
+        prompts = [{"prompt_token_ids": prompt_ids} for prompt_ids in input_ids]
+        outputs = self.llm.generate(prompts, self._sampling_params_for(max_new_tokens), use_tqdm=False)
+        return [self.format_output_from_llama(output.outputs[0].text) for output in outputs]
+
+    def stream_token_prompt_to_llama(self, input_ids: List[int], on_text: Callable[[str], None],
+                                     max_new_tokens: Optional[int] = None) -> str:
+        """
+        Generate text for a tokenized prompt. The offline vLLM engine returns whole replies, so it is handed out at once.
+        """
+        reply = self.submit_token_prompts_to_llama([input_ids], max_new_tokens)[0]
+        on_text(reply)
+        return reply
+
+
+class OpenAICompatibleLlamaService(LlamaService):
+    """
+    A LlamaService that sends prompts to an OpenAI-compatible completions server, such as vLLM's:
+
+        python -m vllm.entrypoints.openai.api_server --model meta-llama/Llama-3.2-3B-Instruct
+            --enable-prefix-caching --dtype auto --max-model-len 8192
+
+    The server pages the KV cache, continuously batches the requests of every consumer process and, with
+    prefix caching, reuses the key/values of the shared prompt prefixes. No model weights are loaded here.
+    """
+
+    def __init__(self):
         """
-        test_reply_prompt = self.create_response_test_prompt_for_llama(query, reply)
-        result = self.submit_prompt_to_llama(test_reply_prompt)
-        return re.search(r"\byes\b", result, re.IGNORECASE)
+        Initialize the tokenizer and the HTTP session.
+        """
+        # Prompts are sent as token IDs, so they are truncated exactly as the other backends truncate them and
+        # the server does not add a second <|begin_of_text|> token
+        self.tokenizer = get_tokenizer()
+        self.max_input_tokens = LLAMA_MAX_INPUT_TOKENS
+        self.max_new_tokens = LLAMA_MAX_NEW_TOKENS
+        self.prompt_prefix_ids = {
+            prefix: self.tokenizer(prefix, add_special_tokens=False).input_ids
+            for prefix in (PROMPT_PREFIX, CONTEXT_PROMPT_PREFIX, RESPONSE_TEST_PROMPT_PREFIX)
+        }
+
+        # Stop at the end of the assistant's turn, not only at the end of the text
+        self.stop_token_ids = get_stop_token_ids(self.tokenizer)
+
+        # The response test is answered with a single token, biased towards " Yes" or " No"
+        self.yes_token_id = self.tokenizer.encode(" Yes", add_special_tokens=False)[0]
+        self.no_token_id = self.tokenizer.encode(" No", add_special_tokens=False)[0]
+
+        # Reuse one connection to the server for every request
+        self.session = requests.Session()
+
+    def complete(self, input_ids: List[List[int]], **parameters) -> List[str]:
+        """
+        Request completions for a batch of tokenized prompts with a single HTTP call.
+
+        Args:
+            input_ids (List[List[int]]): The token IDs of each prompt.
+            **parameters: Further completion parameters, e.g. `max_tokens`.
+
+        Returns:
+            List[str]: The completion of each prompt, in order.
+        """
+        response = self.session.post(
+            f"{LLAMA_SERVER_URL}/completions",
+            json={
+                "model": LLAMA_MODEL_ID,
+                "prompt": input_ids,
+                "temperature": 0.0,                         # Greedy decoding by default, matching the transformers backend
+                **parameters,
+            },
+            timeout=LLAMA_SERVER_TIMEOUT,
+        )
+        response.raise_for_status()
+        choices = sorted(response.json()["choices"], key=lambda choice: choice["index"])
+        return [choice["text"] for choice in choices]
+
+    def were_queries_likely_answered(self, queries: List[str], replies: List[str]) -> List[bool]:
+        """
+        Check, for a batch of queries, whether each reply likely answers its query.
+
+        Args:
+            queries (List[str]): The users' queries.
+            replies (List[str]): The model's replies.
+
+        Returns:
+            List[bool]: True for each reply that likely answers its query.
+        """
+        input_ids = self.encode_prompts(
+            [self.create_response_test_prompt_for_llama(query, reply) for query, reply in zip(queries, replies)],
+            self.max_input_tokens,
+        )
+        verdicts = self.complete(
+            input_ids,
+            max_tokens=1,
+            logit_bias={str(self.yes_token_id): 100, str(self.no_token_id): 100},   # Only " Yes" or " No" can win
+        )
+        return [verdict.strip() == "Yes" for verdict in verdicts]
+
+    def submit_token_prompts_to_llama(self, input_ids: List[List[int]], max_new_tokens: Optional[int] = None) -> List[str]:
+        """
+        Generate text for a batch of tokenized prompts on the completions server.
+
+        Args:
+            input_ids (List[List[int]]): The token IDs of each prompt.
+            max_new_tokens (Optional[int]): The maximum number of tokens to generate; None uses LLAMA_MAX_NEW_TOKENS.
+
+        Returns:
+            List[str]: The generated text for each prompt, in order.
+        """
+        replies = self.complete(
+            input_ids,
+            max_tokens=self.resolve_max_new_tokens(max_new_tokens),
+            temperature=LLAMA_TEMPERATURE,                          # Greedy decoding unless a sampling temperature is set
+            top_p=LLAMA_TOP_P if LLAMA_TEMPERATURE > 0 else 1.0,    # Nucleus sampling, when sampling
+            repetition_penalty=LLAMA_REPETITION_PENALTY,            # vLLM extension: optionally discourage repetition
+            stop_token_ids=self.stop_token_ids,                     # vLLM extension: stop at <|eot_id|> as well as at EOS
+        )
+        return [reply.strip() for reply in replies]
+
+    def stream_token_prompt_to_llama(self, input_ids: List[int], on_text: Callable[[str], None],
+                                     max_new_tokens: Optional[int] = None) -> str:
+        """
+        Generate text for a tokenized prompt. Completions are requested whole, so the reply is handed out at once.
+        """
+        reply = self.submit_token_prompts_to_llama([input_ids], max_new_tokens)[0]
+        on_text(reply)
+        return reply
+
+
+def create_llama_service() -> LlamaService:
+    """
+    Create the LlamaService implementation selected by the LLAMA_BACKEND setting.
+
+    Returns:
+        LlamaService: The service instance.
+    """
+    if LLAMA_BACKEND == "vllm":
+        return VllmLlamaService()
+    if LLAMA_BACKEND == "openai":
+        return OpenAICompatibleLlamaService()
+    return LlamaService()
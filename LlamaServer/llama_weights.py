@@ -0,0 +1,163 @@
+"""
+llama_weights.py
+
+Shared loading of the Llama model weights and tokenizer.
+
+Every LlamaService obtains its model and tokenizer from this module. Loading is memoized, so
+importing several services into the same process keeps a single copy of the weights in GPU
+memory and pays the checkpoint deserialization only once.
+"""
+
+import functools
+import importlib.util
+import logging
+import os
+from typing import Dict, Mapping, Optional
+import torch
+from transformers import AutoModelForCausalLM, AutoTokenizer, BitsAndBytesConfig, PreTrainedModel, PreTrainedTokenizerBase
+
+# Configuration
+LLAMA_MODEL_ID = "meta-llama/Llama-3.2-3B-Instruct"                     # Model identifier on Hugging Face Hub
+LLAMA_QUANTIZATION = os.getenv("LLAMA_QUANTIZATION", "nf4")             # Weight quantization: "nf4", "int8" or "none"
+LLAMA_INT8_THRESHOLD = float(os.getenv("LLAMA_INT8_THRESHOLD", 0.0))   # int8 outlier threshold; 0 skips the slower mixed-precision decomposition
+LLAMA_ATTN_IMPLEMENTATION = os.getenv("LLAMA_ATTN_IMPLEMENTATION", "")  # Attention kernel; empty selects FlashAttention-2 when installed, else SDPA
+
+# Let the CUDA caching allocator grow its segments in place instead of carving new fixed-size blocks, which keeps
+# memory from fragmenting as requests of different lengths come and go. It is read at the first CUDA allocation.
+os.environ.setdefault("PYTORCH_CUDA_ALLOC_CONF", "expandable_segments:True")
+
+
+def select_attn_implementation() -> str:
+    """
+    Select the fused attention kernel used by the model.
+
+    FlashAttention-2 and PyTorch SDPA compute attention in on-chip memory instead of materializing the
+    full attention score matrix, which dominates memory traffic for long prompts. FlashAttention-2 is used
+    when its package is installed and the GPU supports it; SDPA is the fallback.
+
+    Returns:
+        str: The `attn_implementation` value for `from_pretrained()`.
+    """
+    if LLAMA_ATTN_IMPLEMENTATION:
+        return LLAMA_ATTN_IMPLEMENTATION
+    # FlashAttention-2 only runs on Ampere and newer GPUs
+    if (
+        torch.cuda.is_available()
+        and torch.cuda.get_device_capability()[0] >= 8
+        and importlib.util.find_spec("flash_attn") is not None
+    ):
+        return "flash_attention_2"
+
+    # Let SDPA dispatch to its fused FlashAttention and memory-efficient kernels. The math kernel stays
+    # available as the fallback for inputs the fused kernels do not support.
+    if torch.cuda.is_available():
+        torch.backends.cuda.enable_flash_sdp(True)
+        torch.backends.cuda.enable_mem_efficient_sdp(True)
+    return "sdpa"
+
+
+@functools.lru_cache(maxsize=None)
+def select_compute_dtype() -> torch.dtype:
+    """
+    Select the half-precision dtype the model computes in.
+
+    GPUs from Ampere on support bfloat16 natively. It has float32's exponent range, so activations
+    do not overflow as they can in float16. Older GPUs and the CPU use float16.
+
+    Returns:
+        torch.dtype: torch.bfloat16 or torch.float16.
+    """
+    if torch.cuda.is_available() and torch.cuda.get_device_capability()[0] >= 8:
+        return torch.bfloat16
+    return torch.float16
+
+
+def create_quantization_config() -> Optional[BitsAndBytesConfig]:
+    """
+    Create the bitsandbytes weight-only quantization config selected by LLAMA_QUANTIZATION.
+
+    Decoding at batch size 1 is bound by reading the weights from GPU memory, so storing them in
+    4 or 8 bits reduces the bytes moved per generated token. Activations stay in half-precision.
+
+    Returns:
+        Optional[BitsAndBytesConfig]: The quantization config, or None to load the weights in half-precision.
+    """
+    if LLAMA_QUANTIZATION == "nf4":
+        return BitsAndBytesConfig(
+            load_in_4bit=True,                              # Store the weights in 4 bits
+            bnb_4bit_compute_dtype=select_compute_dtype(),  # Dequantize to half-precision for the matmuls
+            bnb_4bit_quant_type="nf4",                      # NormalFloat4 suits normally distributed weights
+            bnb_4bit_use_double_quant=True,                 # Also quantize the per-block scales (~0.4 bits per weight saved)
+        )
+    if LLAMA_QUANTIZATION == "int8":
+        return BitsAndBytesConfig(
+            load_in_8bit=True,                              # Store the weights in 8 bits
+            llm_int8_threshold=LLAMA_INT8_THRESHOLD,        # Activations above this are multiplied in half-precision instead
+        )
+    return None
+
+
+@functools.lru_cache(maxsize=None)
+def get_model(model_id: str = LLAMA_MODEL_ID, quantize: bool = True) -> PreTrainedModel:
+    """
+    Load a causal language model once per process.
+
+    Args:
+        model_id (str): Model identifier on Hugging Face Hub.
+        quantize (bool): Whether to apply the LLAMA_QUANTIZATION weight quantization.
+
+    Returns:
+        PreTrainedModel: The loaded model.
+    """
+    model = AutoModelForCausalLM.from_pretrained(
+        model_id,                                                   # Model identifier on Hugging Face Hub
+        device_map="auto",                                          # Automatically distribute the model across available GPUs
+        torch_dtype=select_compute_dtype(),                         # Use half-precision (BF16 where supported) for better performance
+        quantization_config=create_quantization_config() if quantize else None,    # Weight-only quantization
+        attn_implementation=select_attn_implementation(),           # Fused attention kernel
+        low_cpu_mem_usage=True,                                     # Load the weights without an intermediate CPU copy
+        use_safetensors=True,                                       # Memory-map the safetensors shards
+    )
+    logging.info(f"{model_id} loaded in {model.dtype} with {model.config._attn_implementation} attention.")
+    return model
+
+
+@functools.lru_cache(maxsize=None)
+def get_tokenizer(model_id: str = LLAMA_MODEL_ID) -> PreTrainedTokenizerBase:
+    """
+    Load a tokenizer once per process.
+
+    The tokenizer pads on the left, as required to batch prompts for a decoder-only model, and falls
+    back to the EOS token for padding since the Llama tokenizer does not define a pad token.
+
+    Args:
+        model_id (str): Model identifier on Hugging Face Hub.
+
+    Returns:
+        PreTrainedTokenizerBase: The loaded tokenizer.
+    """
+    tokenizer = AutoTokenizer.from_pretrained(model_id, padding_side="left", use_fast=True)
+    if not tokenizer.is_fast:
+        logging.warning(f"{model_id} has no fast (Rust) tokenizer; tokenization will be slower.")
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
+    return tokenizer
+
+
+def copy_to_device(inputs: Mapping[str, torch.Tensor], device: torch.device) -> Dict[str, torch.Tensor]:
+    """
+    Copy tokenized inputs to the model's device without blocking the host.
+
+    The tensors are staged in pinned (page-locked) host memory so the host-to-device copy is
+    asynchronous; CUDA orders it before the kernels that consume the inputs.
+
+    Args:
+        inputs (Mapping[str, torch.Tensor]): The tokenized inputs, e.g. `input_ids` and `attention_mask`.
+        device (torch.device): The device the model runs on.
+
+    Returns:
+        Dict[str, torch.Tensor]: The inputs on the target device.
+    """
+    if torch.device(device).type != "cuda":
+        return {key: value.to(device) for key, value in inputs.items()}
+    return {key: value.pin_memory().to(device, non_blocking=True) for key, value in inputs.items()}
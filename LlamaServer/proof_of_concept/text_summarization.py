@@ -16,7 +16,7 @@ Version: 1.0.0
 Date: 2025-01-12
 """
 
-from transformers import T5Tokenizer, LongT5ForConditionalGeneration
+from transformers import T5TokenizerFast, LongT5ForConditionalGeneration
 from multiprocessing import freeze_support
 import torch
 
@@ -27,9 +27,20 @@ if __name__ == '__main__':
     # Define the custom directory for storing the model
     custom_model_dir = "Z:/Research/long-t5/cache"
 
-    # Load the tokenizer and model, specifying the cache directory
-    tokenizer = T5Tokenizer.from_pretrained("google/long-t5-tglobal-base", cache_dir=custom_model_dir)
-    model = LongT5ForConditionalGeneration.from_pretrained("google/long-t5-tglobal-base", cache_dir=custom_model_dir)
+    # Load the tokenizer and model, specifying the cache directory.
+    # The fast (Rust) tokenizer is much quicker than the SentencePiece wrapper on long inputs,
+    # and the model runs in bfloat16 on the GPU so attention uses the tensor cores. Unlike float16,
+    # bfloat16 keeps float32's exponent range, so T5's large activations do not overflow.
+    tokenizer = T5TokenizerFast.from_pretrained("google/long-t5-tglobal-base", cache_dir=custom_model_dir)
+    model = LongT5ForConditionalGeneration.from_pretrained(
+        "google/long-t5-tglobal-base",
+        cache_dir=custom_model_dir,
+        torch_dtype=torch.bfloat16
+    ).to("cuda")
+
+    # Compile the encoder, which runs once over the whole (up to 16,384 token) input and dominates the cost.
+    # TorchInductor fuses the layer norms and matmul epilogues into fewer kernels.
+    model.encoder.forward = torch.compile(model.encoder.forward, mode="max-autotune", fullgraph=False)
 
     # Input text for summarization
     input_text = """
@@ -48,6 +59,9 @@ if __name__ == '__main__':
         truncation=True              # Truncate input if necessary
     ).input_ids
 
+    # The embedding lookup accepts int32 IDs, which halves the bytes copied to the GPU
+    input_ids = input_ids.to(torch.int32).pin_memory().to("cuda", non_blocking=True)
+
     input_length = input_ids.size(1)  # Get the number of tokens from the tensor shape
 
     # Set min_length and max_length dynamically (to prevent hallucinations or making the summary too long)
@@ -59,10 +73,9 @@ if __name__ == '__main__':
         input_ids,
         max_length=max_length,      # Set max_length dynamically
         min_length=min_length,      # Set min_length dynamically
-        length_penalty=2.0,         # Encourage longer summaries (within the maximum length)
-        num_beams=2,                # Use beam search for better quality
+        num_beams=1,                # Greedy decoding; a single sequence keeps a single KV cache
         no_repeat_ngram_size=3,     # Avoid repeating n-grams
-        early_stopping=True         # If approppreate, stop generation early
+        use_cache=True              # Reuse past key/values between decoding steps
     )
 
     # Decode the summary
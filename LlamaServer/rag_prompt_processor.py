@@ -17,13 +17,15 @@ Key Features:
 - Communicates with a RabbitMQ message broker for asynchronous query processing.
 
 Dependencies:
-- pika: For RabbitMQ communication.
+- aio-pika: For asyncio-based RabbitMQ communication.
 - llama_service: Custom service for interacting with the Llama model.
 - searxng_summarizer: Custom module for summarizing search results from SearXNG.
 
 Configuration:
 - RabbitMQ connection details are configured via environment variables or default values.
-- The SearXNG instance URL is hardcoded but can be modified as needed.
+- The inference engine is selected with LLAMA_BACKEND ("transformers" by default, "vllm", or "openai" for an
+  OpenAI-compatible server such as vLLM's at LLAMA_SERVER_URL).
+- The SearXNG instance URL is configured via the SEARXNG_INSTANCE_URL environment variable.
 
 Usage:
 1. Ensure RabbitMQ is running and accessible.
@@ -31,6 +33,8 @@ Usage:
 3. Run this script to start the consumer:
    python rag_prompt_processor.py
 4. Send queries to the RabbitMQ queue frontend_to_backend with a reply_to property.
+   An optional max_new_tokens header limits the length of the reply. With a true "stream" header, the reply
+   is also sent in pieces as it is generated, each marked with a "partial" header, before the complete reply.
 
 Example:
 
@@ -50,12 +54,20 @@ Disclaimer:
 
 """
 
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+import asyncio
+import functools
 import os
 import logging
+import re
 import sys
-import pika
-from llama_service import LlamaService
+import threading
+from typing import Callable, List, Optional, Tuple
+import aio_pika
+from llama_service import create_llama_service
+from llama_weights import LLAMA_MODEL_ID
+from response_cache import ResponseCache
 from searxng_summarizer import SearxngSummarizer
 
 # Configure logging
@@ -66,10 +78,259 @@ RABBITMQ_HOST = os.getenv("RABBITMQ_HOST", "localhost")             # RabbitMQ s
 RABBITMQ_PORT = int(os.getenv("RABBITMQ_PORT", 5672))               # RabbitMQ server port
 RABBITMQ_USER = os.getenv("RABBITMQ_USER", "dev_user")              # RabbitMQ username
 RABBITMQ_PASSWORD = os.getenv("RABBITMQ_PASSWORD", "dev_password")  # RabbitMQ password
+RABBITMQ_HEARTBEAT = int(os.getenv("RABBITMQ_HEARTBEAT", 30))       # Seconds between heartbeats; a silent broker is detected after two
+RABBITMQ_CONNECT_TIMEOUT = float(os.getenv("RABBITMQ_CONNECT_TIMEOUT", 5))     # Seconds to wait for the connection to open
 FRONTEND_TO_BACKEND_QUEUE = "frontend_to_backend"
+SEARXNG_INSTANCE_URL = os.getenv("SEARXNG_INSTANCE_URL", "http://127.0.0.1:8080/")     # SearXNG instance used to gather context
+BATCH_MAX_SIZE = int(os.getenv("BATCH_MAX_SIZE", 8))                            # Maximum number of prompts processed together
+BATCH_WINDOW_SECONDS = float(os.getenv("BATCH_WINDOW_SECONDS", 0.02))           # Time to wait for further prompts before processing a batch
+RABBITMQ_PREFETCH_COUNT = int(os.getenv("RABBITMQ_PREFETCH_COUNT", 2 * BATCH_MAX_SIZE))  # Unacknowledged messages the broker delivers ahead
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", 512))                # Number of replies kept for repeated prompts (0 disables)
+RESPONSE_CACHE_TTL_SECONDS = float(os.getenv("RESPONSE_CACHE_TTL_SECONDS", 3600))  # How long a cached reply stays valid
+RESPONSE_CACHE_PATH = os.getenv("RESPONSE_CACHE_PATH", "response_cache.sqlite3")    # SQLite file that keeps replies across restarts ("" keeps them in memory only)
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", 0))        # Reuse replies to prompts at least this similar (e.g. 0.95); 0 disables
+SEMANTIC_CACHE_PATH = os.getenv("SEMANTIC_CACHE_PATH", "semantic_cache.faiss")     # FAISS index that keeps the semantic cache across restarts ("" keeps it in memory only)
+SEMANTIC_CACHE_SIZE = int(os.getenv("SEMANTIC_CACHE_SIZE", 4096))                 # Replies kept in the semantic cache; the oldest are evicted first
+KNOWLEDGE_CUTOFF_YEAR = int(os.getenv("KNOWLEDGE_CUTOFF_YEAR", 2023))            # Last year covered by the model's training data
+
+# Queries about current events, which the model cannot answer from its training data alone
+TIME_SENSITIVE_PATTERN = re.compile(
+    r"\b(today|tonight|tomorrow|yesterday|now|currently|current|latest|newest|recent|recently|this (week|month|year)|"
+    r"news|weather|forecast|score|scores|price|prices|stock|stocks|exchange rate|release date|upcoming)\b",
+    re.IGNORECASE,
+)
+YEAR_PATTERN = re.compile(r"\b(19|20)\d{2}\b")
+
+# The LlamaService is created on first use, so importing this module (e.g. from tests or the console script)
+# does not load the model
+llama_service = None
+llama_service_lock = threading.Lock()
+
+# Initialize the SearXNG summarizer once, so its HTTP connections are reused across queries
+summarizer = SearxngSummarizer(SEARXNG_INSTANCE_URL)
+
+# Replies to recently seen prompts, so retried or repeated messages skip the model entirely
+response_cache = ResponseCache(RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL_SECONDS, RESPONSE_CACHE_PATH, namespace=LLAMA_MODEL_ID)
+
+# Optionally, replies to recent prompts that are worded differently but mean the same thing
+semantic_cache = None
+if SEMANTIC_CACHE_THRESHOLD > 0:
+    from semantic_cache import SemanticCache
+    semantic_cache = SemanticCache(
+        SEMANTIC_CACHE_THRESHOLD, RESPONSE_CACHE_TTL_SECONDS, SEMANTIC_CACHE_PATH or None, max_size=SEMANTIC_CACHE_SIZE
+    )
+
+# Replies being published in the background while the next batch is processed
+publish_tasks = set()
+
+# The model runs on one dedicated thread, off the event loop. Batches reach the GPU one at a time and always
+# from the same thread, and the default executor stays free for other blocking work.
+inference_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="llama-inference")
+
+
+def get_llama_service():
+    """
+    Get the LlamaService, creating it on first use.
+
+    Prompts are processed in worker threads, so the creation is guarded by a lock: threads arriving while
+    the model loads wait for it instead of loading a second copy.
+
+    Returns:
+        The LlamaService of the selected backend.
+    """
+    global llama_service
+    if llama_service is None:
+        with llama_service_lock:
+            if llama_service is None:
+                llama_service = create_llama_service()
+    return llama_service
 
-# Initialize LlamaService
-llama_service = LlamaService()
+
+def needs_retrieval(query: str) -> bool:
+    """
+    Decide, before generating anything, whether a query needs web search results to be answered.
+
+    Queries about current events or about years after the model's knowledge cutoff go straight to the search
+    pipeline, instead of first generating an answer without context that would be judged unanswered.
+
+    Args:
+        query (str): The user's query.
+
+    Returns:
+        bool: True if the query should be answered with search results.
+    """
+    if TIME_SENSITIVE_PATTERN.search(query):
+        return True
+    return any(int(match.group()) > KNOWLEDGE_CUTOFF_YEAR for match in YEAR_PATTERN.finditer(query))
+
+
+@functools.lru_cache(maxsize=1)
+def get_date_notice(day: date) -> str:
+    """
+    Get the notice of today's date that precedes the search results, formatted once per day.
+
+    The notice stays byte-identical for every request of the day, so its tokens and any cached key/values
+    that follow from them can be reused.
+
+    Args:
+        day (date): The current date.
+
+    Returns:
+        str: The date notice.
+    """
+    return f"For reference, today is {day.strftime('%A, %d %B %Y')}, but the following information could be older...\n\n"
+
+
+def process_prompts(queries: List[str], max_new_tokens: Optional[int] = None) -> List[str]:
+    """
+    Process a batch of user queries by generating responses using the Llama model and/or SearXNG summarizer.
+
+    Every Llama step is submitted for the whole batch at once, so the GPU decodes the queries together.
+
+    Args:
+        queries (List[str]): The users' queries.
+        max_new_tokens (Optional[int]): The maximum number of tokens per response; None uses the service's default.
+
+    Returns:
+        List[str]: The generated response for each query, in order.
+    """
+    logging.info("Processing %d queries", len(queries))
+    logging.debug("Queries: %s", queries)
+
+    try:
+        llama_service = get_llama_service()
+
+        # First, attempt to answer the queries without additional context, unless they obviously need search results
+        llama_replies = [""] * len(queries)
+        unanswered = [index for index, query in enumerate(queries) if needs_retrieval(query)]
+        attempted = [index for index, query in enumerate(queries) if index not in unanswered]
+        if attempted:
+            attempted_queries = [queries[index] for index in attempted]
+            attempted_replies = llama_service.submit_queries_without_context_to_llama(attempted_queries, max_new_tokens)
+
+            # Check which queries were likely answered
+            answered = llama_service.were_queries_likely_answered(attempted_queries, attempted_replies)
+            for index, reply, is_answered in zip(attempted, attempted_replies, answered):
+                llama_replies[index] = reply
+                if not is_answered:
+                    unanswered.append(index)
+        if not unanswered:
+            return llama_replies
+
+        # For the others, use SearXNG to gather additional context
+        date_notice = get_date_notice(date.today())
+        search_results = [f"{date_notice}{summarizer.process_query(queries[index])}" for index in unanswered]
+
+        # Submit the queries with the gathered context
+        context_replies = llama_service.submit_queries_with_context_to_llama(
+            [queries[index] for index in unanswered], search_results, max_new_tokens
+        )
+        for index, reply in zip(unanswered, context_replies):
+            llama_replies[index] = reply
+        return llama_replies
+    except Exception as e:
+        logging.error("Error processing queries: %s", e)
+        return [""] * len(queries)
+
+
+def process_uncached_prompts(queries: List[str], max_new_tokens: Optional[int] = None) -> List[str]:
+    """
+    Process a batch of user queries, answering those similar enough to an earlier query from the semantic cache.
+
+    Args:
+        queries (List[str]): The users' queries.
+        max_new_tokens (Optional[int]): The maximum number of tokens per response; None uses the service's default.
+            Only replies of the default length are shared through the semantic cache.
+
+    Returns:
+        List[str]: The generated response for each query, in order.
+    """
+    if semantic_cache is None or max_new_tokens is not None:
+        return process_prompts(queries, max_new_tokens)
+
+    replies = semantic_cache.get_many(queries)
+    misses = [index for index, reply in enumerate(replies) if reply is None]
+    if misses:
+        generated = process_prompts([queries[index] for index in misses])
+        for index, reply in zip(misses, generated):
+            replies[index] = reply
+
+        # Empty replies signal a failure; don't cache them
+        answered = [(queries[index], reply) for index, reply in zip(misses, generated) if reply]
+        semantic_cache.put_many([query for query, _ in answered], [reply for _, reply in answered])
+    return replies
+
+
+def stream_prompt(query: str, on_text: Callable[[str], None], max_new_tokens: Optional[int] = None) -> str:
+    """
+    Process a user query like `process_prompts`, handing out the final answer in pieces as it is generated.
+
+    Only the final answer is streamed: an answer without context that is judged unanswered is not sent.
+
+    Args:
+        query (str): The user's query.
+        on_text (Callable[[str], None]): Called with each new piece of the response.
+        max_new_tokens (Optional[int]): The maximum number of tokens of the response; None uses the service's default.
+
+    Returns:
+        str: The complete generated response.
+    """
+    logging.info("Streaming the reply to a query")
+    logging.debug("Query: %s", query)
+
+    try:
+        llama_service = get_llama_service()
+
+        # First, attempt to answer the query without additional context, unless it obviously needs search results
+        if not needs_retrieval(query):
+            reply = llama_service.submit_queries_without_context_to_llama([query], max_new_tokens)[0]
+            if llama_service.were_queries_likely_answered([query], [reply])[0]:
+                on_text(reply)
+                return reply
+
+        # Otherwise, use SearXNG to gather additional context and stream the answer based on it
+        context = f"{get_date_notice(date.today())}{summarizer.process_query(query)}"
+        started = False
+
+        def on_piece(text: str):
+            nonlocal started
+            if not started:
+                text = text.lstrip()                                            # Replies are stripped, so are their first pieces
+            if text:
+                started = True
+                on_text(text)
+
+        # generate() runs right here, on the inference thread, and hands out the pieces as it decodes them
+        return llama_service.stream_query_with_context_to_llama(query, context, on_piece, max_new_tokens)
+    except Exception as e:
+        logging.error("Error streaming query: %s", e)
+        return ""
+
+
+def stream_uncached_prompt(query: str, on_text: Callable[[str], None], max_new_tokens: Optional[int] = None) -> str:
+    """
+    Stream the reply to a user query, answering it from the semantic cache when an earlier query is similar enough.
+
+    Args:
+        query (str): The user's query.
+        on_text (Callable[[str], None]): Called with each new piece of the response.
+        max_new_tokens (Optional[int]): The maximum number of tokens of the response; None uses the service's default.
+            Only replies of the default length are shared through the semantic cache.
+
+    Returns:
+        str: The complete generated response.
+    """
+    if semantic_cache is None or max_new_tokens is not None:
+        return stream_prompt(query, on_text, max_new_tokens)
+
+    reply = semantic_cache.get_many([query])[0]
+    if reply is not None:
+        on_text(reply)
+        return reply
+    reply = stream_prompt(query, on_text)
+    if reply:                                                                   # Empty replies signal a failure; don't cache them
+        semantic_cache.put_many([query], [reply])
+    return reply
 
 
 def process_prompt(query: str) -> str:
@@ -82,110 +343,345 @@ def process_prompt(query: str) -> str:
     Returns:
         str: The generated response.
     """
-    logging.info(f"Processing query: {query}")
+    return process_prompts([query])[0]
+
+
+def get_max_new_tokens(message: aio_pika.abc.AbstractIncomingMessage) -> Optional[int]:
+    """
+    Read the reply length limit a message asks for in its "max_new_tokens" header.
 
+    Args:
+        message: The incoming message.
+
+    Returns:
+        Optional[int]: The requested maximum number of tokens, or None if the header is missing or invalid.
+    """
+    value = (message.headers or {}).get("max_new_tokens")
+    if value is None:
+        return None
     try:
-        # First, attempt to answer the query without additional context
-        llama_reply = llama_service.submit_query_without_context_to_llama(query)
-
-        # Check if the query was likely answered
-        if llama_service.was_query_likely_answered(query, llama_reply):
-            return llama_reply
-        else:
-            # If not, use SearXNG to gather additional context
-            searxng_instance_url = "http://127.0.0.1:8080/"
-            summarizer = SearxngSummarizer(searxng_instance_url)
-            search_result = (
-                f"For reference, today is {datetime.now().strftime('%A, %d %B %Y')}, "
-                "but the following information could be older...\n\n"
-                f"{summarizer.process_query(query)}"
-            )
-
-            # Submit the query with the gathered context
-            return llama_service.submit_query_with_context_to_llama(query, context=search_result)
-    except Exception as e:
-        logging.error(f"Error processing query: {e}")
-        return ""
+        max_new_tokens = int(value.decode("utf-8") if isinstance(value, bytes) else value)
+    except (TypeError, ValueError):
+        logging.warning("Ignoring invalid max_new_tokens header: %r", value)
+        return None
+    return max_new_tokens if max_new_tokens > 0 else None
 
 
-def setup_rabbitmq_connection():
+def wants_streamed_reply(message: aio_pika.abc.AbstractIncomingMessage) -> bool:
     """
-    Set up and return a RabbitMQ connection and channel.
+    Check whether a message asks, in its "stream" header, for its reply to be sent as it is generated.
+
+    Args:
+        message: The incoming message.
 
     Returns:
-        tuple: A tuple containing the RabbitMQ connection and channel.
+        bool: True if the reply should be streamed.
+    """
+    value = (message.headers or {}).get("stream")
+    if isinstance(value, bytes):
+        value = value.decode("utf-8")
+    if isinstance(value, str):
+        return value.strip().lower() in ("1", "true", "yes")
+    return bool(value)
+
+
+async def setup_rabbitmq_connection():
+    """
+    Set up and return a RabbitMQ connection, channel and the queue to consume from.
+
+    Returns:
+        tuple: A tuple containing the RabbitMQ connection, channel and queue.
     """
     try:
-        credentials = pika.PlainCredentials(RABBITMQ_USER, RABBITMQ_PASSWORD)
-        connection = pika.BlockingConnection(
-            pika.ConnectionParameters(
-                host=RABBITMQ_HOST,
-                port=RABBITMQ_PORT,
-                credentials=credentials,
-            )
+        connection = await aio_pika.connect_robust(
+            host=RABBITMQ_HOST,
+            port=RABBITMQ_PORT,
+            login=RABBITMQ_USER,
+            password=RABBITMQ_PASSWORD,
+            heartbeat=RABBITMQ_HEARTBEAT,                                   # Detect dead connections and reconnect
+            timeout=RABBITMQ_CONNECT_TIMEOUT,                               # Fail fast instead of hanging on an unreachable broker
         )
-        channel = connection.channel()
-        channel.queue_declare(queue=FRONTEND_TO_BACKEND_QUEUE, durable=False)
+        channel = await connection.channel(publisher_confirms=True)            # Each publish completes once the broker has taken the reply
+
+        # Bound the messages held by this consumer. A full next batch is delivered while the current one runs on
+        # the GPU, and the rest stay on the broker, where another consumer can take them.
+        await channel.set_qos(prefetch_count=RABBITMQ_PREFETCH_COUNT)
+        queue = await channel.declare_queue(FRONTEND_TO_BACKEND_QUEUE, durable=False)
         logging.info("RabbitMQ connection and dedicated queue set up successfully.")
-        return connection, channel
-    except pika.exceptions.AMQPError as e:
-        logging.error(f"Failed to set up RabbitMQ connection: {e}")
+        return connection, channel, queue
+    except (aio_pika.exceptions.AMQPError, ConnectionError) as e:
+        logging.error("Failed to set up RabbitMQ connection: %s", e)
         sys.exit(1)
 
 
-def callback(ch, method, properties, body):
+async def reply_to_message(channel: aio_pika.abc.AbstractChannel, message: aio_pika.abc.AbstractIncomingMessage, reply: str):
     """
-    Callback function to process incoming messages from RabbitMQ.
+    Publish the reply to an incoming message, then acknowledge the message.
+
+    The message is only acknowledged once the broker has confirmed the reply, so a message whose reply was
+    lost is redelivered instead of being dropped.
 
     Args:
-        ch: The RabbitMQ channel.
-        method: The method frame.
-        properties: The message properties.
-        body: The message body.
+        channel: The RabbitMQ channel.
+        message: The incoming message.
+        reply: The generated reply.
     """
-    try:
-        prompt = body.decode("utf-8")
-        reply = process_prompt(prompt)
-
-        # Use the ReplyTo property from the incoming message to send the reply
-        if properties.reply_to:
-            ch.basic_publish(
-                exchange="",
-                routing_key=properties.reply_to,                # Use the ReplyTo queue
+    # Use the ReplyTo property from the incoming message to send the reply
+    if message.reply_to:
+        await channel.default_exchange.publish(
+            aio_pika.Message(
                 body=reply.encode("utf-8"),
-                properties=pika.BasicProperties(
-                    correlation_id=properties.correlation_id,   # Include the correlation ID
-                    delivery_mode=1,                            # Make messages transient
-                ),
-            )
-            logging.info(f"Processed and replied to prompt: {prompt}")
-        else:
-            logging.error("No ReplyTo property found in the incoming message.")
+                correlation_id=message.correlation_id,                  # Include the correlation ID
+                delivery_mode=aio_pika.DeliveryMode.NOT_PERSISTENT,     # Make messages transient
+            ),
+            routing_key=message.reply_to,                               # Use the ReplyTo queue
+        )
+        logging.info("Processed and replied to message: %s", message.correlation_id)
+    else:
+        logging.error("No ReplyTo property found in the incoming message.")
+    await message.ack()
+
+
+async def reject_messages(messages: List[aio_pika.abc.AbstractIncomingMessage]):
+    """
+    Negatively acknowledge the messages that have not been acknowledged yet.
+
+    A failed message is requeued once, and dropped if it fails again after redelivery.
+
+    Args:
+        messages: The incoming messages.
+    """
+    for message in messages:
+        if not message.processed:
+            await message.nack(requeue=not message.redelivered)
+
+
+async def publish_replies(channel: aio_pika.abc.AbstractChannel, messages: List[aio_pika.abc.AbstractIncomingMessage], replies: List[str]):
+    """
+    Publish the replies to some messages at once and wait for the broker's confirms together.
+
+    Args:
+        channel: The RabbitMQ channel.
+        messages: The incoming messages.
+        replies: The reply to each message.
+    """
+    try:
+        await asyncio.gather(*(reply_to_message(channel, message, reply) for message, reply in zip(messages, replies)))
     except Exception as e:
-        logging.error(f"Error processing message: {e}")
+        logging.error("Error publishing replies: %s", e)
+        await reject_messages(messages)
 
 
-def start_consumer():
+def start_publishing_replies(channel: aio_pika.abc.AbstractChannel, messages: List[aio_pika.abc.AbstractIncomingMessage], replies: List[str]):
     """
-    Start the RabbitMQ consumer to listen for incoming messages.
+    Publish replies in the background, so the next batch does not wait for the broker's confirms.
+
+    Args:
+        channel: The RabbitMQ channel.
+        messages: The incoming messages.
+        replies: The reply to each message.
+    """
+    if not messages:
+        return
+    task = asyncio.create_task(publish_replies(channel, messages, replies))
+    publish_tasks.add(task)                                                     # Keep a reference until the task is done
+    task.add_done_callback(publish_tasks.discard)
+
+
+async def publish_partial_reply(channel: aio_pika.abc.AbstractChannel, message: aio_pika.abc.AbstractIncomingMessage, text: str):
+    """
+    Publish a piece of a streamed reply, marked with a "partial" header. The message is not acknowledged yet.
+
+    Args:
+        channel: The RabbitMQ channel.
+        message: The incoming message.
+        text: The new piece of the reply.
+    """
+    if not message.reply_to:
+        return
+    try:
+        await channel.default_exchange.publish(
+            aio_pika.Message(
+                body=text.encode("utf-8"),
+                headers={"partial": True},                              # The complete reply follows without this header
+                correlation_id=message.correlation_id,
+                delivery_mode=aio_pika.DeliveryMode.NOT_PERSISTENT,
+            ),
+            routing_key=message.reply_to,
+        )
+    except Exception as e:
+        logging.warning("Error publishing partial reply: %s", e)
+
+
+async def stream_reply(channel: aio_pika.abc.AbstractChannel, message: aio_pika.abc.AbstractIncomingMessage, key: str,
+                       max_new_tokens: Optional[int]):
     """
-    connection, channel = setup_rabbitmq_connection()
+    Generate the reply to a message that asked for streaming, publishing its pieces as they are generated.
+
+    The pieces are published in order by a single task, while the model runs on the inference thread. The
+    complete reply is published last, which acknowledges the message.
+
+    Args:
+        channel: The RabbitMQ channel.
+        message: The incoming message.
+        key: The response cache key of the message.
+        max_new_tokens: The maximum number of tokens of the reply; None uses the service's default.
+    """
+    loop = asyncio.get_running_loop()
+    pieces = asyncio.Queue()
+
+    async def publish_pieces():
+        while (text := await pieces.get()) is not None:
+            await publish_partial_reply(channel, message, text)
+
+    publisher = asyncio.create_task(publish_pieces())
     try:
-        channel.basic_consume(
-            queue=FRONTEND_TO_BACKEND_QUEUE,
-            on_message_callback=callback,
-            auto_ack=True,
+        reply = await loop.run_in_executor(
+            inference_executor, stream_uncached_prompt, message.body.decode("utf-8"),
+            lambda text: loop.call_soon_threadsafe(pieces.put_nowait, text), max_new_tokens,
         )
+    finally:
+        loop.call_soon_threadsafe(pieces.put_nowait, None)                     # After any pieces still being handed over
+        await publisher
+
+    if reply:                                                                   # Empty replies signal a failure; don't cache them
+        response_cache.put(key, reply)
+    start_publishing_replies(channel, [message], [reply])
+
+
+async def process_batch(channel: aio_pika.abc.AbstractChannel, messages: List[aio_pika.abc.AbstractIncomingMessage]):
+    """
+    Process a batch of incoming messages from RabbitMQ and reply to each of them.
+
+    The prompts that miss the caches are generated together in one batched `generate()` call per Llama step.
+    Replies are published in the background, so the next batch can start on the GPU straight away.
+    Messages that asked for a streamed reply are generated one at a time after the batched ones, so they
+    don't hold back the rest of the batch; they still wait for it, and for each other, to finish.
+
+    Args:
+        channel: The RabbitMQ channel.
+        messages: The incoming messages, in arrival order.
+    """
+    remaining = messages
+    try:
+        # Answer repeated prompts from the cache, keyed on the raw body so cache hits are never decoded.
+        # Their replies are sent straight away rather than after the rest of the batch has been generated.
+        limits = [get_max_new_tokens(message) for message in messages]
+        keys = [
+            response_cache.make_key(message.body, f"max_new_tokens={limit}" if limit else "")
+            for message, limit in zip(messages, limits)
+        ]
+        replies = [response_cache.get(key) for key in keys]
+        hits = [index for index, reply in enumerate(replies) if reply is not None]
+        start_publishing_replies(channel, [messages[index] for index in hits], [replies[index] for index in hits])
+
+        remaining = [message for message, reply in zip(messages, replies) if reply is None]
+        uncached = [
+            (message, key, limit, wants_streamed_reply(message))
+            for message, key, limit, reply in zip(messages, keys, limits, replies) if reply is None
+        ]
+        batched = [(message, key, limit) for message, key, limit, is_streamed in uncached if not is_streamed]
+        streamed = [(message, key, limit) for message, key, limit, is_streamed in uncached if is_streamed]
+
+        await generate_batched_replies(channel, batched)
+
+        # Messages that asked for a streamed reply are generated one at a time, as their tokens are handed out
+        for message, key, limit in streamed:
+            await stream_reply(channel, message, key, limit)
+    except Exception as e:
+        logging.error("Error processing messages: %s", e)
+        await reject_messages(remaining)
+
+
+async def generate_batched_replies(channel: aio_pika.abc.AbstractChannel, batched: List[Tuple[aio_pika.abc.AbstractIncomingMessage, str, Optional[int]]]):
+    """
+    Generate the replies to uncached messages together and publish them in the background.
+
+    Args:
+        channel: The RabbitMQ channel.
+        batched: The messages, with their response cache keys and reply length limits.
+    """
+    if not batched:
+        return
+
+    # Decode and run each distinct uncached prompt once, grouped by the reply length they ask for
+    misses = {}
+    for message, key, limit in batched:
+        if key not in misses:
+            misses[key] = (message.body.decode("utf-8"), limit)
+
+    # Run the model on the inference thread so the event loop keeps receiving messages in the meantime
+    loop = asyncio.get_running_loop()
+    generated = {}
+    for limit in dict.fromkeys(limit for _, limit in misses.values()):
+        group = [key for key, (_, key_limit) in misses.items() if key_limit == limit]
+        queries = [misses[key][0] for key in group]
+        group_replies = await loop.run_in_executor(inference_executor, process_uncached_prompts, queries, limit)
+        generated.update(zip(group, group_replies))
+    for key, reply in generated.items():
+        if reply:                                                               # Empty replies signal a failure; don't cache them
+            response_cache.put(key, reply)
+
+    start_publishing_replies(channel, [message for message, _, _ in batched], [generated[key] for _, key, _ in batched])
+
+
+async def process_batches(channel: aio_pika.abc.AbstractChannel, pending: asyncio.Queue):
+    """
+    Take messages from the pending queue and process them in batches.
+
+    A batch starts with the first pending message and collects further messages for up to
+    BATCH_WINDOW_SECONDS, or until it holds BATCH_MAX_SIZE messages.
+
+    Args:
+        channel: The RabbitMQ channel.
+        pending: The queue that received messages are put on.
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        messages = [await pending.get()]
+        deadline = loop.time() + BATCH_WINDOW_SECONDS
+        while len(messages) < BATCH_MAX_SIZE:
+            try:
+                messages.append(await asyncio.wait_for(pending.get(), timeout=max(0.0, deadline - loop.time())))
+            except asyncio.TimeoutError:
+                break
+        await process_batch(channel, messages)
+
+
+async def consume():
+    """
+    Consume messages from RabbitMQ until cancelled.
+    """
+    connection, channel, queue = await setup_rabbitmq_connection()
+    try:
+        pending = asyncio.Queue()
+        await queue.consume(pending.put)                                        # Messages are acknowledged after their reply is published
         logging.info("Waiting for messages. To exit, press CTRL+C")
-        channel.start_consuming()
+        await process_batches(channel, pending)
+    finally:
+        await asyncio.gather(*publish_tasks, return_exceptions=True)           # Let in-flight replies finish first
+        await connection.close()
+        inference_executor.shutdown(wait=True)                                 # Let a running batch finish before closing the caches
+        response_cache.close()
+        summarizer.close()
+        if semantic_cache is not None:
+            semantic_cache.save()
+        logging.info("RabbitMQ connection closed.")
+
+
+def start_consumer():
+    """
+    Start the RabbitMQ consumer to listen for incoming messages.
+    """
+    try:
+        # Load the model before the first message arrives, on the inference thread that runs every generate().
+        # CUDA graphs captured by the torch.compile warm-up are thread-local, so they must be recorded there.
+        inference_executor.submit(get_llama_service).result()
+        asyncio.run(consume())
     except KeyboardInterrupt:
         logging.info("Consumer interrupted by user. Shutting down gracefully...")
     except Exception as e:
-        logging.error(f"Error in consumer: {e}")
-    finally:
-        if connection and connection.is_open:
-            connection.close()
-            logging.info("RabbitMQ connection closed.")
+        logging.error("Error in consumer: %s", e)
 
 
 if __name__ == "__main__":
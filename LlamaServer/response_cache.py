@@ -0,0 +1,148 @@
+"""
+response_cache.py
+
+A cache of generated replies, keyed by the raw bytes of the incoming message body.
+
+Retried or redelivered RabbitMQ messages, and users asking the same question twice, would otherwise run
+the whole generate()/SearXNG pipeline again. The cache lets the consumer answer those straight away.
+Entries expire after a time-to-live because replies that used web search results go stale.
+
+Recently used replies are kept in memory. Optionally, every reply is also written to a SQLite database,
+so the cache survives restarts of the consumer. The database runs in WAL mode without an fsync per write,
+and writes are committed at most once per COMMIT_INTERVAL_SECONDS, so storing a reply does not stall the
+caller on disk I/O. A crash loses at most the last interval's replies, which are only cached answers.
+"""
+
+import hashlib
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+COMMIT_INTERVAL_SECONDS = 1.0   # Minimum time between commits of new replies to the SQLite store
+
+
+class ResponseCache:
+    """
+    A thread-safe LRU cache of replies with time-to-live (TTL) eviction and an optional SQLite store.
+    """
+
+    def __init__(self, max_size: int = 512, ttl_seconds: float = 3600.0, db_path: Optional[str] = None, namespace: str = ""):
+        """
+        Initialize the cache.
+
+        Args:
+            max_size (int): The maximum number of replies kept in memory. 0 disables the cache.
+            ttl_seconds (float): How long a reply stays valid, in seconds.
+            db_path (Optional[str]): The SQLite database that persists replies; None keeps them in memory only.
+            namespace (str): Mixed into every key, e.g. the model ID, so replies of another model are never served.
+        """
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.namespace = namespace.encode("utf-8")
+        self._entries: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+        self._db = None
+        if db_path and max_size > 0:
+            self._db = sqlite3.connect(db_path, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")         # Append writes to a log instead of rewriting pages
+            self._db.execute("PRAGMA synchronous=NORMAL")       # Only fsync at checkpoints, not on every commit
+            self._db.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, reply TEXT NOT NULL, expires_at REAL NOT NULL)")
+            self._db.execute("DELETE FROM responses WHERE expires_at <= ?", (time.time(),))
+            self._db.commit()
+        self._last_commit = time.monotonic()
+
+    def make_key(self, body: bytes, variant: str = "") -> str:
+        """
+        Hash a message body into a compact cache key, without decoding it.
+
+        Args:
+            body (bytes): The raw message body.
+            variant (str): Request options that change the reply, e.g. its length limit.
+
+        Returns:
+            str: The cache key.
+        """
+        digest = hashlib.blake2b(self.namespace, digest_size=16)
+        digest.update(b"\0")
+        digest.update(body)
+        if variant:
+            digest.update(b"\0")
+            digest.update(variant.encode("utf-8"))
+        return digest.hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        """
+        Look up a reply, in memory first and then in the SQLite store.
+
+        Args:
+            key (str): The cache key, as returned by make_key().
+
+        Returns:
+            Optional[str]: The cached reply, or None if it is missing or expired.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires_at, reply = entry
+                if expires_at > time.monotonic():
+                    self._entries.move_to_end(key)
+                    return reply
+                del self._entries[key]
+
+            if self._db is None:
+                return None
+            row = self._db.execute(
+                "SELECT reply, expires_at FROM responses WHERE key = ? AND expires_at > ?", (key, time.time())
+            ).fetchone()
+            if row is None:
+                return None
+            reply, expires_at = row
+            self._remember(key, reply, expires_at - time.time())
+            return reply
+
+    def put(self, key: str, reply: str):
+        """
+        Store a reply, evicting the least recently used one from memory if the cache is full.
+
+        Args:
+            key (str): The cache key, as returned by make_key().
+            reply (str): The reply to cache.
+        """
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._remember(key, reply, self.ttl_seconds)
+            if self._db is not None:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO responses (key, reply, expires_at) VALUES (?, ?, ?)",
+                    (key, reply, time.time() + self.ttl_seconds),
+                )
+                if time.monotonic() - self._last_commit >= COMMIT_INTERVAL_SECONDS:
+                    self._db.commit()
+                    self._last_commit = time.monotonic()
+
+    def _remember(self, key: str, reply: str, ttl_seconds: float):
+        """
+        Add a reply to the in-memory LRU. The caller must hold the lock.
+        """
+        self._entries[key] = (time.monotonic() + ttl_seconds, reply)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def close(self):
+        """
+        Commit the pending replies and close the SQLite store, if there is one. Replies kept in memory remain available.
+        """
+        with self._lock:
+            if self._db is not None:
+                self._db.commit()
+                self._db.close()
+                self._db = None
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._entries)
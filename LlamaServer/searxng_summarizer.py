@@ -24,6 +24,8 @@ Dependencies:
     - requests
     - transformers
     - torch
+    - lxml (parses fetched webpages when selectolax is not installed)
+    - selectolax (optional; a faster HTML parser, used when installed)
 
 Configuration:
     - Set the `searxng_instance_url` to the URL of your SearXNG instance.
@@ -43,15 +45,50 @@ Disclaimer:
 """
 
 import requests
+import heapq
 import os
 import logging
-
-from typing import List, TypedDict, NotRequired
+import threading
+import time
+import torch
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Tuple, TypedDict, NotRequired
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from transformers import T5Tokenizer, LongT5ForConditionalGeneration
+from llama_weights import copy_to_device
+
+# selectolax is an optional, faster HTML parser; lxml is used when it is not installed
+try:
+    from selectolax.parser import HTMLParser
+except ImportError:
+    HTMLParser = None
 
 # Define the custom directory for storing the model
 LLM_LONG_T5_CACHE = os.getenv("LLM_LONG_T5_CACHE", "Z:/Research/long-t5/cache")
 
+# HTTP settings for requests to SearXNG and the result webpages
+HTTP_TIMEOUT = (3, 10)          # Seconds to connect, and to wait for data
+HTTP_POOL_SIZE = 32             # Connections kept open per host, and webpages fetched at once
+HTTP_RETRIES = 2                # Retries for failed connections and gateway errors
+HTTP_RETRY_BACKOFF = 0.2        # Seconds before the second retry, doubling after; the first retry is immediate
+
+SEARXNG_MAX_RESULTS = int(os.getenv("SEARXNG_MAX_RESULTS", 16))    # Best-scoring search results kept per query
+SEARXNG_MIN_SCORE = 1.5         # Search results scoring lower are dropped
+SEARXNG_CACHE_SIZE = int(os.getenv("SEARXNG_CACHE_SIZE", 1024))                 # Queries whose search results are kept (0 disables)
+SEARXNG_CACHE_TTL_SECONDS = float(os.getenv("SEARXNG_CACHE_TTL_SECONDS", 300))  # How long cached search results stay fresh
+
+# Webpage scraping is off by default (see process_query); set the number of top results whose pages are fetched (e.g. 3)
+SEARXNG_MAX_PAGES = int(os.getenv("SEARXNG_MAX_PAGES", 0))
+SNIPPETS_SUFFICIENT_CHARS = 4000    # Search result snippets this long already give enough context; no pages are fetched
+MAX_PAGE_CHARS = 4000           # Characters of page text kept per result
+MAX_PAGE_BYTES = 512 * 1024     # Bytes of HTML downloaded per webpage; the rest of a larger page is ignored
+SUMMARY_INPUT_TOKENS = 1024     # Tokens of each search result kept when results are summarized one by one
+SEARXNG_SUMMARIZE = os.getenv("SEARXNG_SUMMARIZE", "0") == "1"     # Condense each result with LongT5 before it becomes context (off, see process_query)
+CONTENT_TAGS = ("p", "h1", "h2", "h3", "h4", "h5", "h6", "li")  # Elements holding a page's content, rather than navigation or boilerplate
+
 # Configure logging
 logging.basicConfig(
     level=logging.DEBUG,                                    # Set the logging level (INFO, WARNING, ERROR, etc.)
@@ -88,16 +125,75 @@ class SearxngSummarizer:
             "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36"
         }
 
+        # Share one session across requests, so connections are pooled and kept alive instead of being
+        # opened (and DNS resolved) for every search
+        adapter = HTTPAdapter(
+            pool_connections=HTTP_POOL_SIZE,
+            pool_maxsize=HTTP_POOL_SIZE,
+            max_retries=Retry(total=HTTP_RETRIES, backoff_factor=HTTP_RETRY_BACKOFF, status_forcelist=(502, 503, 504)),
+        )
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers.update(self.headers)
+
+        # Fetch webpages on threads that live as long as the summarizer, rather than starting a pool per query
+        self.executor = ThreadPoolExecutor(max_workers=HTTP_POOL_SIZE, thread_name_prefix="webpage-fetch")
+
+        # The LongT5 tokenizer and model are loaded on the first summary and then reused (see load_summarization_model)
+        self.summarization_tokenizer = None
+        self.summarization_model = None
+        self.summarization_model_lock = threading.Lock()
+
+        # Recent search results by normalized query, so repeated and retried queries skip the HTTP round trip
+        self.search_cache: "OrderedDict[str, Tuple[float, List[SearxngSummarizer.SearchResult]]]" = OrderedDict()
+        self.search_cache_lock = threading.Lock()
+
+    def close(self):
+        """
+        Stop the webpage fetching threads and close the pooled HTTP connections.
+        """
+        self.executor.shutdown(wait=False)
+        self.session.close()
+
     def search_searxng(self, query: str) -> List[SearchResult]:
         """
         Search a SearXNG instance for the given query and return sorted results.
 
+        Results are cached for SEARXNG_CACHE_TTL_SECONDS, keyed by the query with its case and whitespace
+        normalized. Callers get their own copies, which they are free to modify.
+
+        :param query: The search query.
+        :return: List of search results, filtered and sorted by score.
+        """
+        key = " ".join(query.split()).casefold()
+        now = time.monotonic()
+        with self.search_cache_lock:
+            entry = self.search_cache.get(key)
+            if entry is not None and entry[0] > now:
+                self.search_cache.move_to_end(key)
+                logger.info("Reusing cached search results.")
+                return [dict(result) for result in entry[1]]
+
+        results = self.fetch_search_results(query)
+        if SEARXNG_CACHE_SIZE > 0:
+            with self.search_cache_lock:
+                self.search_cache[key] = (now + SEARXNG_CACHE_TTL_SECONDS, [dict(result) for result in results])
+                self.search_cache.move_to_end(key)
+                while len(self.search_cache) > SEARXNG_CACHE_SIZE:
+                    self.search_cache.popitem(last=False)
+        return results
+
+    def fetch_search_results(self, query: str) -> List[SearchResult]:
+        """
+        Query the SearXNG instance and return the filtered results, sorted by score.
+
         :param query: The search query.
         :return: List of search results, filtered and sorted by score.
         """
         params = {"q": query, "format": "json"}
         try:
-            response = requests.get(self.searxng_instance_url, params=params, headers=self.headers)
+            response = self.session.get(self.searxng_instance_url, params=params, timeout=HTTP_TIMEOUT)
             response.raise_for_status()  # Raise an exception for HTTP errors
         except requests.exceptions.RequestException as e:
             logger.error(f"Failed to fetch results from SearXNG: {e}")
@@ -105,12 +201,125 @@ class SearxngSummarizer:
 
         results: List[self.SearchResult] = response.json().get("results", [])
 
-        # Filter out low-scoring results
-        filtered_results = [result for result in results if result.get("score", 0) >= 1.5]
+        # Keep the best-scoring results, best first, dropping the low-scoring ones. A heap selects the top K
+        # without sorting every result.
+        filtered_results = heapq.nlargest(
+            SEARXNG_MAX_RESULTS,
+            (result for result in results if result.get("score", 0) >= SEARXNG_MIN_SCORE),
+            key=lambda result: result.get("score", 0),
+        )
 
         logger.info(f"Found {len(filtered_results)} results after filtering.")
         return filtered_results
 
+    @staticmethod
+    def extract_text(html: bytes) -> str:
+        """
+        Extract the content text of an HTML document.
+
+        Only paragraphs, headings and list items are kept, which drops most menus, footers and other
+        boilerplate the LLM would otherwise have to read. Pages without any of those elements fall back
+        to all of their visible text. List items wrapping paragraphs are skipped, so their text is not
+        kept twice.
+
+        The document is parsed with selectolax when it is installed, and with lxml otherwise. Both parse
+        in C, and both detect the encoding from the raw bytes.
+
+        :param html: The HTML document.
+        :return: The content text, with whitespace collapsed.
+        """
+        if HTMLParser is not None:
+            tree = HTMLParser(html)
+            for node in tree.css("script, style, noscript"):
+                node.decompose()
+            texts = [
+                node.text(separator=" ")
+                for node in tree.css(", ".join(CONTENT_TAGS))
+                if node.tag != "li" or node.css_first("p") is None
+            ]
+            if not texts:
+                root = tree.body or tree.root
+                texts = [root.text(separator=" ")] if root is not None else []
+        else:
+            import lxml.etree
+            import lxml.html
+
+            try:
+                document = lxml.html.fromstring(html)
+            except lxml.etree.ParserError:
+                return ""
+            for element in document.xpath("//script | //style | //noscript"):
+                element.drop_tree()
+            texts = [
+                element.text_content()
+                for element in document.xpath(" | ".join(f"//{tag}" for tag in CONTENT_TAGS))
+                if element.tag != "li" or not element.xpath(".//p")
+            ]
+            if not texts:
+                texts = [document.text_content()]
+        return " ".join(" ".join(texts).split())
+
+    def fetch_webpage_content(self, url: str) -> str:
+        """
+        Fetch a webpage and extract its visible text.
+
+        Only the first MAX_PAGE_BYTES of the page are downloaded, so a pathologically large page cannot
+        stall the query or exhaust memory.
+
+        :param url: The URL of the webpage.
+        :return: The text of the webpage, or an empty string if it could not be fetched.
+        """
+        try:
+            response = self.session.get(url, timeout=HTTP_TIMEOUT, stream=True)
+            try:
+                response.raise_for_status()
+                html = response.raw.read(MAX_PAGE_BYTES, decode_content=True)
+            finally:
+                response.close()
+        except (requests.exceptions.RequestException, OSError) as e:
+            logger.warning(f"Failed to fetch webpage {url}: {e}")
+            return ""
+        return self.extract_text(html)
+
+    def fetch_webpages(self, urls: List[str]) -> List[str]:
+        """
+        Fetch several webpages concurrently and extract their visible text.
+
+        The fetches are network bound, so running them on a thread pool makes the wall time that of
+        the slowest page rather than the sum of all of them.
+
+        :param urls: The URLs of the webpages.
+        :return: The text of each webpage, in order.
+        """
+        if not urls:
+            return []
+        return list(self.executor.map(self.fetch_webpage_content, urls))
+
+    def load_summarization_model(self):
+        """
+        Load the LongT5 tokenizer and model once, on first use.
+
+        Summaries are optional, so the consumer does not pay for the weights unless it summarizes. The model
+        runs on the GPU when there is one, in bfloat16 where supported; T5 models overflow in float16, so other
+        GPUs and the CPU keep float32.
+
+        :return: The tokenizer and the model.
+        """
+        with self.summarization_model_lock:
+            if self.summarization_model is None:
+                try:
+                    # Load the tokenizer and model, specifying the cache directory
+                    self.summarization_tokenizer = T5Tokenizer.from_pretrained("google/long-t5-tglobal-base", cache_dir=LLM_LONG_T5_CACHE)
+                    device = "cuda" if torch.cuda.is_available() else "cpu"
+                    dtype = torch.bfloat16 if device == "cuda" and torch.cuda.is_bf16_supported() else torch.float32
+                    self.summarization_model = LongT5ForConditionalGeneration.from_pretrained(
+                        "google/long-t5-tglobal-base", cache_dir=LLM_LONG_T5_CACHE, torch_dtype=dtype
+                    ).to(device).eval()
+                except Exception as e:
+                    logger.error(f"Failed to load tokenizer or model: {e}")
+                    raise
+        return self.summarization_tokenizer, self.summarization_model
+
     def summarize(self, input_text: str) -> str:
         """
         Summarize the input text using the LongT5 model.
@@ -121,25 +330,18 @@ class SearxngSummarizer:
         :param input_text: The text to summarize.
         :return: The summarized text.
         """
-
-        try:
-            # Load the tokenizer and model, specifying the cache directory
-            tokenizer = T5Tokenizer.from_pretrained("google/long-t5-tglobal-base", cache_dir=LLM_LONG_T5_CACHE)
-            model = LongT5ForConditionalGeneration.from_pretrained("google/long-t5-tglobal-base", cache_dir=LLM_LONG_T5_CACHE)
-        except Exception as e:
-            logger.error(f"Failed to load tokenizer or model: {e}")
-            raise
+        tokenizer, model = self.load_summarization_model()
 
         # Prepare the input text with a summarization prompt
         prompt_text = f"summarize: {input_text}"
 
-        # Tokenize the input text
-        input_ids = tokenizer(
+        # Tokenize the input text on the CPU, then copy it to the GPU without blocking
+        input_ids = copy_to_device(tokenizer(
             prompt_text,
             return_tensors="pt",  # Return PyTorch tensors
             max_length=16384,     # Set maximum input length
             truncation=True       # Truncate input if necessary
-        ).input_ids
+        ), model.device)["input_ids"]
 
         input_length = input_ids.size(1)  # Get the number of tokens in the input
 
@@ -147,22 +349,64 @@ class SearxngSummarizer:
         min_length = 1
         max_length = min(150, int(0.3 * input_length))  # At most 150 tokens, or 30% of input length
 
-        # Generate the summary using the model
-        summary_ids = model.generate(
-            input_ids,
-            max_length=max_length,      # Set max_length dynamically
-            min_length=min_length,      # Set min_length dynamically
-            length_penalty=1.5,         # Encourage longer summaries (within the maximum length)
-            num_beams=5,                # Use beam search for better quality
-            no_repeat_ngram_size=2,     # Avoid repeating n-grams
-            early_stopping=False        # Stop generation early if appropriate
-        )
+        # Generate the summary using the model, without autograd bookkeeping
+        with torch.inference_mode():
+            summary_ids = model.generate(
+                input_ids,
+                max_length=max_length,      # Set max_length dynamically
+                min_length=min_length,      # Set min_length dynamically
+                length_penalty=1.5,         # Encourage longer summaries (within the maximum length)
+                num_beams=5,                # Use beam search for better quality
+                no_repeat_ngram_size=2,     # Avoid repeating n-grams
+                early_stopping=False        # Stop generation early if appropriate
+            )
 
         # Decode and return the summary
         summarized_text = tokenizer.decode(summary_ids[0], skip_special_tokens=True)
         logger.debug(f"Summarized Search Results: {summarized_text}")
         return summarized_text
 
+    def summarize_many(self, input_texts: List[str]) -> List[str]:
+        """
+        Summarize several texts, e.g. one per search result, with a single batched LongT5 call.
+
+        Each text is truncated to SUMMARY_INPUT_TOKENS, so the attention cost grows with the number of texts
+        instead of with the square of their combined length, and the batch keeps the GPU busy.
+
+        :param input_texts: The texts to summarize.
+        :return: The summary of each text, in order.
+        """
+        if not input_texts:
+            return []
+        tokenizer, model = self.load_summarization_model()
+
+        # Tokenize the texts together, padding them to the longest one, and copy them to the GPU without blocking
+        inputs = copy_to_device(tokenizer(
+            [f"summarize: {input_text}" for input_text in input_texts],
+            return_tensors="pt",                # Return PyTorch tensors
+            padding=True,                       # Pad the batch to its longest text
+            max_length=SUMMARY_INPUT_TOKENS,    # Set maximum input length per text
+            truncation=True                     # Truncate inputs if necessary
+        ), model.device)
+
+        # At most 150 tokens, or 30% of the longest input
+        max_length = max(2, min(150, int(0.3 * inputs["input_ids"].size(1))))
+
+        # Generate the summaries using the model, without autograd bookkeeping
+        with torch.inference_mode():
+            summary_ids = model.generate(
+                **inputs,
+                max_length=max_length,      # Set max_length dynamically
+                min_length=1,               # Allow short summaries of short results
+                length_penalty=1.5,         # Encourage longer summaries (within the maximum length)
+                num_beams=2,                # A narrow beam keeps the batch affordable
+                no_repeat_ngram_size=2,     # Avoid repeating n-grams
+            )
+
+        summaries = tokenizer.batch_decode(summary_ids, skip_special_tokens=True)
+        logger.debug(f"Summarized {len(summaries)} search results")
+        return summaries
+
     def process_query(self, query: str) -> str:
         """
         Process a search query: search, fetch content, and summarize.
@@ -173,15 +417,26 @@ class SearxngSummarizer:
         logger.info(f"Processing query: {query}")
         query_results = self.search_searxng(query)
 
-        # Combine titles, URLs, and content from search results into a single string
-        summary_input = ""
+        # Optionally replace the snippets of the top results with the text of their webpages. Fetching pages
+        # costs an HTTP round trip and a parse each, so it is skipped when the snippets are long enough already.
+        snippets_length = sum(len(result.get("content", "")) for result in query_results)
+        if SEARXNG_MAX_PAGES > 0 and snippets_length < SNIPPETS_SUFFICIENT_CHARS:
+            page_texts = self.fetch_webpages([result["url"] for result in query_results[:SEARXNG_MAX_PAGES]])
+            for result, page_text in zip(query_results, page_texts):
+                if page_text:
+                    result["content"] = page_text[:MAX_PAGE_CHARS]
+
+        # Optionally condense the content of every result with LongT5, all in one batched call
+        if SEARXNG_SUMMARIZE:
+            summarized = [result for result in query_results if result.get("content")]
+            for result, summary in zip(summarized, self.summarize_many([result["content"] for result in summarized])):
+                result["content"] = summary
+
+        # Combine titles, URLs, and content from search results into a single string, joined once
         try:
-            for result in query_results:
-                summary_input += (
-                    f"{result['title']}\n"
-                    f"{result['url']}\n"
-                    f"{result['content']}\n\n"
-                )
+            summary_input = "".join(
+                f"{result['title']}\n{result['url']}\n{result['content']}\n\n" for result in query_results
+            )
         except Exception as e:
             logger.error(f"Error during search result processing: {e}")
             raise
@@ -0,0 +1,175 @@
+"""
+semantic_cache.py
+
+A cache of generated replies that also matches prompts which are worded differently but mean the same thing.
+
+Each prompt is embedded with a small sentence-transformers model. A new prompt whose embedding has a cosine
+similarity above a threshold to a cached prompt is answered with that prompt's reply, without running the
+Llama model. The embeddings are held in a FAISS inner-product index, which on normalized vectors computes
+the cosine similarity.
+
+sentence-transformers and faiss are optional dependencies, only required when the cache is enabled.
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+import numpy as np
+
+SEARCH_NEIGHBORS = 4    # Cached prompts compared per lookup, so an expired match does not hide a fresh one
+
+
+class SemanticCache:
+    """
+    A thread-safe cache of replies, looked up by embedding similarity of the prompts.
+    """
+
+    def __init__(self, threshold: float = 0.95, ttl_seconds: float = 3600.0, index_path: Optional[str] = None,
+                 model_name: str = "sentence-transformers/all-MiniLM-L6-v2", max_size: int = 4096):
+        """
+        Load the embedding model and the saved index, if there is one.
+
+        Args:
+            threshold (float): The minimum cosine similarity for a cached reply to be reused.
+            ttl_seconds (float): How long a reply stays valid, in seconds.
+            index_path (Optional[str]): Where the FAISS index is saved; None keeps it in memory only.
+                The replies are saved next to it, in a file with the same name and a ".json" suffix.
+            model_name (str): The sentence-transformers model that embeds the prompts.
+            max_size (int): The maximum number of cached replies; the oldest are evicted first.
+        """
+        # Both libraries are optional dependencies, only required when this cache is enabled
+        import faiss
+        from sentence_transformers import SentenceTransformer
+
+        self._faiss = faiss
+        self.threshold = threshold
+        self.ttl_seconds = ttl_seconds
+        self.index_path = index_path
+        self.max_size = max_size
+        self.model = SentenceTransformer(model_name)
+        self._lock = threading.Lock()
+
+        # The index holds one embedding per cached prompt under a unique ID, which maps to its reply and creation
+        # time. IDs only ever grow, so the dict is ordered from the oldest reply to the newest.
+        self._replies: Dict[int, Tuple[str, float]] = {}
+        self._next_id = 0
+        self.index = faiss.IndexIDMap(faiss.IndexFlatIP(self.model.get_sentence_embedding_dimension()))
+        if index_path and os.path.exists(index_path):
+            with open(f"{index_path}.json", encoding="utf-8") as replies_file:
+                entries = json.load(replies_file)
+            if all(len(entry) == 3 for entry in entries):
+                self.index = faiss.read_index(index_path)
+                self._replies = {int(entry_id): (reply, created_at) for entry_id, reply, created_at in entries}
+                self._next_id = max(self._replies, default=-1) + 1
+                self._evict(time.time())
+                logging.info(f"Loaded {len(self._replies)} replies into the semantic cache from {index_path}")
+            else:
+                # Indexes saved before replies had IDs cannot remove entries; start over
+                logging.warning(f"Ignoring the semantic cache at {index_path}, which was saved in an older format")
+
+    def _embed(self, prompts: List[str]):
+        """
+        Embed prompts as unit-length float32 vectors.
+        """
+        return self.model.encode(prompts, convert_to_numpy=True, normalize_embeddings=True).astype("float32")
+
+    def _remove(self, ids: List[int]):
+        """
+        Remove replies from the index and the replies. The lock must be held.
+        """
+        if not ids:
+            return
+        self.index.remove_ids(np.asarray(ids, dtype="int64"))
+        for entry_id in ids:
+            self._replies.pop(entry_id, None)
+
+    def _evict(self, now: float, room: int = 0):
+        """
+        Remove the expired replies, and the oldest ones until `room` more fit within max_size. The lock must be held.
+        """
+        stale = [entry_id for entry_id, (_, created_at) in self._replies.items() if now - created_at >= self.ttl_seconds]
+        self._remove(stale)
+        excess = len(self._replies) + room - self.max_size
+        if excess > 0:
+            self._remove(list(self._replies)[:excess])
+
+    def get_many(self, prompts: List[str]) -> List[Optional[str]]:
+        """
+        Look up the reply to each prompt.
+
+        Args:
+            prompts (List[str]): The prompts.
+
+        Returns:
+            List[Optional[str]]: For each prompt, the reply to the most similar cached prompt, or None if no
+                cached prompt is similar enough or its reply has expired.
+        """
+        if not prompts:
+            return []
+        embeddings = self._embed(prompts)
+        with self._lock:
+            if self.index.ntotal == 0:
+                return [None] * len(prompts)
+            scores, ids = self.index.search(embeddings, min(SEARCH_NEIGHBORS, self.index.ntotal))
+
+            replies = []
+            now = time.time()
+            for prompt_scores, prompt_ids in zip(scores, ids):
+                reply = None
+                for score, entry_id in zip(prompt_scores, prompt_ids):
+                    if entry_id < 0 or score < self.threshold:
+                        break                                       # Neighbors come best first
+                    cached_reply, created_at = self._replies[int(entry_id)]
+                    if now - created_at < self.ttl_seconds:
+                        reply = cached_reply
+                        break
+                replies.append(reply)
+            return replies
+
+    def put_many(self, prompts: List[str], replies: List[str]):
+        """
+        Cache the replies to some prompts.
+
+        A cached reply to a prompt similar enough to a new one is replaced, and expired replies are removed.
+        If the cache is full, the oldest replies are evicted.
+
+        Args:
+            prompts (List[str]): The prompts.
+            replies (List[str]): The reply to each prompt.
+        """
+        if not prompts:
+            return
+        embeddings = self._embed(prompts)
+        now = time.time()
+        with self._lock:
+            if self.index.ntotal > 0:
+                scores, ids = self.index.search(embeddings, 1)
+                self._remove(sorted({int(entry_id) for score, entry_id in zip(scores[:, 0], ids[:, 0])
+                                     if entry_id >= 0 and score >= self.threshold}))
+            self._evict(now, room=len(prompts))
+
+            new_ids = list(range(self._next_id, self._next_id + len(prompts)))
+            self._next_id += len(prompts)
+            self.index.add_with_ids(embeddings, np.asarray(new_ids, dtype="int64"))
+            self._replies.update((entry_id, (reply, now)) for entry_id, reply in zip(new_ids, replies))
+            if len(self._replies) > self.max_size:
+                self._remove(list(self._replies)[:len(self._replies) - self.max_size])
+
+    def save(self):
+        """
+        Save the index and the replies, if an index path was given.
+        """
+        if not self.index_path:
+            return
+        with self._lock:
+            self._faiss.write_index(self.index, self.index_path)
+            with open(f"{self.index_path}.json", "w", encoding="utf-8") as replies_file:
+                json.dump([[entry_id, reply, created_at] for entry_id, (reply, created_at) in self._replies.items()], replies_file)
+        logging.info(f"Saved {len(self._replies)} semantic cache replies to {self.index_path}")
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._replies)
@@ -0,0 +1,210 @@
+import unittest
+from collections import OrderedDict
+from types import SimpleNamespace
+import torch
+from transformers import DynamicCache, LlamaConfig, LlamaForCausalLM, LogitsProcessorList, NoRepeatNGramLogitsProcessor
+from llama_service import (
+    CONTEXT_PROMPT_PREFIX, PROMPT_PREFIX, RESPONSE_TEST_PROMPT_PREFIX, BeamSharedPrefixCache, CallbackTextStreamer,
+    DeviceNoRepeatNGramLogitsProcessor, LlamaService,
+)
+from llama_weights import get_tokenizer
+
+class TestDeviceNoRepeatNGramLogitsProcessor(unittest.TestCase):
+    def assert_same_bans(self, ngram_size: int, input_ids: torch.LongTensor, vocab_size: int = 16):
+        scores = torch.zeros((input_ids.shape[0], vocab_size))
+        expected = NoRepeatNGramLogitsProcessor(ngram_size)(input_ids, scores.clone())
+        actual = DeviceNoRepeatNGramLogitsProcessor(ngram_size)(input_ids, scores.clone())
+        self.assertTrue(torch.equal(torch.isinf(actual), torch.isinf(expected)), f"n={ngram_size}, ids={input_ids.tolist()}")
+
+    def test_matches_transformers_for_short_inputs(self):
+        for ngram_size in (1, 2, 3, 4):
+            for seq_len in range(1, ngram_size + 2):
+                self.assert_same_bans(ngram_size, torch.arange(seq_len).remainder(2).repeat(2, 1))
+
+    def test_matches_transformers_for_long_inputs(self):
+        generator = torch.Generator().manual_seed(0)
+        for ngram_size in (1, 2, 3, 4):
+            input_ids = torch.randint(0, 4, (3, 40), generator=generator)
+            self.assert_same_bans(ngram_size, input_ids)
+
+class WordTokenizer:
+    """
+    A stand-in tokenizer with one token per whitespace-separated word.
+    """
+    def __init__(self):
+        self.vocabulary = {}
+
+    def __call__(self, texts, add_special_tokens=False):
+        return SimpleNamespace(input_ids=[
+            [self.vocabulary.setdefault(word, len(self.vocabulary)) for word in text.split()] for text in texts
+        ])
+
+class TestEncodeContextPrompts(unittest.TestCase):
+    def setUp(self):
+        self.service = LlamaService.__new__(LlamaService)     # Skip loading the model
+        self.service.tokenizer = WordTokenizer()
+        self.service.prompt_prefix_ids = {CONTEXT_PROMPT_PREFIX: self.service.tokenizer([CONTEXT_PROMPT_PREFIX]).input_ids[0]}
+        self.query = "Who wrote the report?"
+        self.rest_ids = self.service.tokenizer(
+            [self.service.create_prompt_restricted_to_context_info_for_llama(self.query, "")[len(CONTEXT_PROMPT_PREFIX):]]
+        ).input_ids[0]
+
+    def test_long_context_loses_its_end(self):
+        prefix_ids = self.service.prompt_prefix_ids[CONTEXT_PROMPT_PREFIX]
+        context = " ".join(f"word{index}" for index in range(1000))
+        max_length = len(prefix_ids) + len(self.rest_ids) + 10
+
+        input_ids = self.service.encode_context_prompts([self.query], [context], max_length)[0]
+        self.assertEqual(len(input_ids), max_length)
+        self.assertEqual(input_ids[:len(prefix_ids)], prefix_ids)
+        self.assertEqual(input_ids[-len(self.rest_ids):], self.rest_ids)
+        context_ids = self.service.tokenizer([context]).input_ids[0]
+        self.assertEqual(input_ids[len(prefix_ids):-len(self.rest_ids)], context_ids[:10])
+
+    def test_short_context_is_kept_whole(self):
+        input_ids = self.service.encode_context_prompts([self.query], ["A short context."], 4096)[0]
+        prefix_ids = self.service.prompt_prefix_ids[CONTEXT_PROMPT_PREFIX]
+        context_ids = self.service.tokenizer(["A short context."]).input_ids[0]
+        self.assertEqual(input_ids, prefix_ids + context_ids + self.rest_ids)
+
+class TokenIdTokenizer:
+    """
+    A stand-in tokenizer that pads token IDs on the left and "decodes" them to their numbers.
+    """
+    pad_token_id = 0
+
+    def pad(self, encoded_inputs, padding=True, pad_to_multiple_of=None, return_tensors="pt"):
+        rows = encoded_inputs["input_ids"]
+        length = max(len(row) for row in rows)
+        if pad_to_multiple_of:
+            length = -(-length // pad_to_multiple_of) * pad_to_multiple_of
+        return {
+            "input_ids": torch.tensor([[self.pad_token_id] * (length - len(row)) + row for row in rows]),
+            "attention_mask": torch.tensor([[0] * (length - len(row)) + [1] * len(row) for row in rows]),
+        }
+
+    def batch_decode(self, sequences, skip_special_tokens=True):
+        return [" ".join(str(token_id) for token_id in row.tolist()) for row in sequences]
+
+def create_tiny_service() -> LlamaService:
+    """
+    Create a LlamaService around a tiny, randomly initialised Llama model on the CPU.
+    """
+    torch.manual_seed(0)
+    config = LlamaConfig(
+        vocab_size=64, hidden_size=32, intermediate_size=64, num_hidden_layers=2,
+        num_attention_heads=4, num_key_value_heads=2, max_position_embeddings=256,
+    )
+    service = LlamaService.__new__(LlamaService)                # Skip loading the real model
+    service.model = LlamaForCausalLM(config).eval()
+    service.tokenizer = TokenIdTokenizer()
+    service.max_new_tokens = 12
+    service.pad_to_multiple_of = None
+    service.stop_token_ids = [1]
+    service.sampling_kwargs = {}
+    service.logits_processor = LogitsProcessorList()
+    service.assistant_model = None
+    service.torch_compile = False
+    service.static_caches = OrderedDict()
+    service.prefix_caches = {}
+    service.prompt_prefix_ids = {PROMPT_PREFIX: list(range(2, 10)), CONTEXT_PROMPT_PREFIX: list(range(10, 24))}
+    return service
+
+class TestPrefixCaches(unittest.TestCase):
+    def test_prefix_cache_does_not_change_the_output(self):
+        service = create_tiny_service()
+        for prefix in (PROMPT_PREFIX, CONTEXT_PROMPT_PREFIX):
+            with self.subTest(prefix=prefix[:40]):
+                prompt = service.prompt_prefix_ids[prefix] + torch.randint(24, 64, (20,)).tolist()
+
+                service.prefix_caches = {}
+                expected = service.submit_token_prompts_to_llama([prompt])
+                service.build_prefix_caches()
+                self.assertIsNotNone(service.get_prefix_cache(prompt))
+                self.assertEqual(service.submit_token_prompts_to_llama([prompt]), expected)
+
+class TestBeamSharedPrefixCache(unittest.TestCase):
+    def setUp(self):
+        self.model = create_tiny_service().model
+
+    def assert_same_beams(self, input_ids: torch.LongTensor, attention_mask: torch.LongTensor, prefill: bool):
+        generate_kwargs = {
+            "attention_mask": attention_mask, "num_beams": 2, "early_stopping": True, "max_new_tokens": 8,
+            "do_sample": False, "pad_token_id": 0,
+        }
+        with torch.inference_mode():
+            expected = self.model.generate(input_ids, past_key_values=DynamicCache(), **generate_kwargs)
+            beam_cache = BeamSharedPrefixCache(2)
+            if prefill:
+                beam_cache.prefill(self.model, input_ids, attention_mask)
+            actual = self.model.generate(input_ids, past_key_values=beam_cache, **generate_kwargs)
+        self.assertTrue(torch.equal(actual, expected), f"{actual.tolist()} != {expected.tolist()}")
+
+    def test_matches_dynamic_cache_for_one_prompt(self):
+        input_ids = torch.randint(2, 64, (1, 12))
+        for prefill in (False, True):
+            with self.subTest(prefill=prefill):
+                self.assert_same_beams(input_ids, torch.ones_like(input_ids), prefill)
+
+    def test_matches_dynamic_cache_for_left_padded_batch(self):
+        input_ids = torch.randint(2, 64, (3, 12))
+        attention_mask = torch.ones_like(input_ids)
+        for row, padding in ((1, 4), (2, 7)):
+            input_ids[row, :padding] = 0
+            attention_mask[row, :padding] = 0
+        for prefill in (False, True):
+            with self.subTest(prefill=prefill):
+                self.assert_same_beams(input_ids, attention_mask, prefill)
+
+class WordListTokenizer:
+    """
+    A stand-in tokenizer that decodes token IDs to the words of a fixed list.
+    """
+    words = ["Prompt ", "The ", "home ", "team ", "won."]
+
+    def decode(self, token_ids, **decode_kwargs):
+        return "".join(self.words[token_id] for token_id in token_ids)
+
+class TestCallbackTextStreamer(unittest.TestCase):
+    def test_hands_out_generated_words_without_the_prompt(self):
+        pieces = []
+        streamer = CallbackTextStreamer(WordListTokenizer(), pieces.append, skip_prompt=True)
+        streamer.put(torch.tensor([[0]]))                           # generate() passes the prompt first
+        for token_id in (1, 2, 3, 4):
+            streamer.put(torch.tensor([token_id]))
+        streamer.end()
+        self.assertEqual("".join(pieces), "The home team won.")
+        self.assertTrue(all(pieces))
+
+class TestPromptTokenization(unittest.TestCase):
+    """
+    The cached prefix IDs and the text after them must give the same tokens as the whole prompt.
+    Needs the Llama tokenizer, and is skipped when it cannot be loaded.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        try:
+            tokenizer = get_tokenizer()
+        except Exception as e:
+            raise unittest.SkipTest(f"Llama tokenizer unavailable: {e}")
+        cls.service = LlamaService.__new__(LlamaService)
+        cls.service.tokenizer = tokenizer
+        cls.service.prompt_prefix_ids = {
+            prefix: tokenizer(prefix, add_special_tokens=False).input_ids
+            for prefix in (PROMPT_PREFIX, CONTEXT_PROMPT_PREFIX, RESPONSE_TEST_PROMPT_PREFIX)
+        }
+
+    def test_prompt_tokens_match_whole_prompt(self):
+        prompt = self.service.create_prompt_for_llama("Is life but a dream?")
+        whole = self.service.tokenizer(prompt, add_special_tokens=False).input_ids
+        self.assertEqual(self.service.encode_prompts([prompt])[0], whole)
+
+    def test_context_prompt_tokens_match_whole_prompt(self):
+        query, context = "Who won?", "\nThe home team won 3-1.\n\nSource: example.com"
+        prompt = self.service.create_prompt_restricted_to_context_info_for_llama(query, context)
+        whole = self.service.tokenizer(prompt, add_special_tokens=False).input_ids
+        self.assertEqual(self.service.encode_context_prompts([query], [context])[0], whole)
+
+if __name__ == "__main__":
+    unittest.main()
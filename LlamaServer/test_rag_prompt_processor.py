@@ -0,0 +1,83 @@
+import asyncio
+import os
+import unittest
+from unittest.mock import AsyncMock, Mock, patch
+
+os.environ.setdefault("RESPONSE_CACHE_PATH", "")    # Keep the response cache of the imported consumer in memory
+import rag_prompt_processor
+from rag_prompt_processor import needs_retrieval, stream_prompt, stream_reply
+
+class TestNeedsRetrieval(unittest.TestCase):
+    @patch("rag_prompt_processor.KNOWLEDGE_CUTOFF_YEAR", 2023)
+    def test_time_sensitive_queries_need_retrieval(self):
+        for query in (
+            "What is the weather in Paris today?",
+            "Who won the game last night? Show me the latest scores",
+            "What is the current price of gold?",
+            "Any NEWS about the Mars mission?",
+            "What happened this week in tech?",
+            "When is the release date of the next iPhone?",
+            "Who won the 2024 election?",
+            "Best laptops of 2025",
+        ):
+            with self.subTest(query=query):
+                self.assertTrue(needs_retrieval(query))
+
+    @patch("rag_prompt_processor.KNOWLEDGE_CUTOFF_YEAR", 2023)
+    def test_timeless_queries_are_answered_first(self):
+        for query in (
+            "Is life but a dream?",
+            "Explain the Pythagorean theorem.",
+            "Who won the 1998 World Cup?",
+            "What happened in 2023?",
+            "Write a haiku about knowledge.",      # "now" only as part of another word
+            "How do stockings get their name?",    # "stock" only as part of another word
+            "Convert 1024 bytes to kilobytes.",    # Not a year
+        ):
+            with self.subTest(query=query):
+                self.assertFalse(needs_retrieval(query))
+
+class TestStreamPrompt(unittest.TestCase):
+    @patch("rag_prompt_processor.summarizer")
+    @patch("rag_prompt_processor.get_llama_service")
+    def test_context_answer_is_streamed_without_leading_whitespace(self, mock_get_llama_service, mock_summarizer):
+        def stream_query_with_context(query, context, on_text, max_new_tokens=None):
+            for text in ("\n ", " The", " answer."):
+                on_text(text)
+            return "The answer."
+
+        llama_service = mock_get_llama_service.return_value
+        llama_service.stream_query_with_context_to_llama.side_effect = stream_query_with_context
+        mock_summarizer.process_query.return_value = "Search results"
+
+        pieces = []
+        reply = stream_prompt("What is the latest news?", pieces.append)     # Needs retrieval, so no first attempt
+        self.assertEqual(reply, "The answer.")
+        self.assertEqual(pieces, ["The", " answer."])
+        llama_service.submit_queries_without_context_to_llama.assert_not_called()
+
+class TestStreamReply(unittest.IsolatedAsyncioTestCase):
+    async def test_pieces_are_published_in_order_before_the_acknowledged_reply(self):
+        published = []
+        channel = Mock()
+        channel.default_exchange.publish = AsyncMock(side_effect=lambda message, routing_key: published.append(message))
+        message = Mock(body=b"Who won?", reply_to="replies", correlation_id="42", headers={"stream": True})
+        message.ack = AsyncMock(side_effect=lambda: self.assertEqual(len(published), 4))  # Only after the complete reply
+
+        def fake_stream_prompt(query, on_text, max_new_tokens=None):
+            for text in ("The ", "home ", "team."):
+                on_text(text)
+            return "The home team."
+
+        with patch("rag_prompt_processor.stream_uncached_prompt", fake_stream_prompt):
+            await stream_reply(channel, message, "key", None)
+            await asyncio.gather(*rag_prompt_processor.publish_tasks)
+
+        self.assertEqual([sent.body for sent in published], [b"The ", b"home ", b"team.", b"The home team."])
+        self.assertEqual([sent.headers.get("partial") for sent in published], [True, True, True, None])
+        self.assertTrue(all(sent.correlation_id == "42" for sent in published))
+        message.ack.assert_awaited_once()
+        self.assertEqual(rag_prompt_processor.response_cache.get("key"), "The home team.")
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,76 @@
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+from response_cache import ResponseCache
+
+class TestResponseCache(unittest.TestCase):
+    def setUp(self):
+        self.cache = ResponseCache(max_size=2, ttl_seconds=60)
+
+    def test_get_returns_stored_reply(self):
+        key = self.cache.make_key("What is RAG?".encode("utf-8"))
+        self.cache.put(key, "Retrieval-Augmented Generation.")
+        self.assertEqual(self.cache.get(key), "Retrieval-Augmented Generation.")
+        self.assertIsNone(self.cache.get(self.cache.make_key(b"Another question")))
+
+    def test_keys_depend_on_namespace(self):
+        body = b"What is RAG?"
+        self.assertNotEqual(
+            ResponseCache(namespace="model-a").make_key(body),
+            ResponseCache(namespace="model-b").make_key(body),
+        )
+
+    def test_keys_depend_on_variant(self):
+        body = b"What is RAG?"
+        self.assertEqual(self.cache.make_key(body), self.cache.make_key(body, ""))
+        self.assertNotEqual(self.cache.make_key(body), self.cache.make_key(body, "max_new_tokens=64"))
+
+    def test_least_recently_used_reply_is_evicted(self):
+        self.cache.put("a", "A")
+        self.cache.put("b", "B")
+        self.cache.get("a")
+        self.cache.put("c", "C")
+        self.assertEqual(len(self.cache), 2)
+        self.assertEqual(self.cache.get("a"), "A")
+        self.assertIsNone(self.cache.get("b"))
+
+    @patch("response_cache.time.monotonic")
+    def test_expired_reply_is_dropped(self, mock_monotonic):
+        mock_monotonic.return_value = 100.0
+        self.cache.put("a", "A")
+        mock_monotonic.return_value = 161.0
+        self.assertIsNone(self.cache.get("a"))
+        self.assertEqual(len(self.cache), 0)
+
+    def test_replies_persist_in_sqlite(self):
+        with tempfile.TemporaryDirectory() as directory:
+            db_path = os.path.join(directory, "responses.sqlite3")
+            cache = ResponseCache(db_path=db_path)
+            key = cache.make_key(b"What is RAG?")
+            cache.put(key, "Retrieval-Augmented Generation.")
+            cache.close()
+
+            reopened = ResponseCache(db_path=db_path)
+            self.assertEqual(reopened.get(key), "Retrieval-Augmented Generation.")
+            reopened.close()
+
+    def test_pending_replies_are_committed_on_close(self):
+        with tempfile.TemporaryDirectory() as directory:
+            db_path = os.path.join(directory, "responses.sqlite3")
+            cache = ResponseCache(db_path=db_path)
+            cache.put("a", "A")
+            cache.put("b", "B")                                 # Within the commit interval of the first reply
+            cache.close()
+
+            reopened = ResponseCache(db_path=db_path)
+            self.assertEqual((reopened.get("a"), reopened.get("b")), ("A", "B"))
+            reopened.close()
+
+    def test_zero_size_disables_cache(self):
+        cache = ResponseCache(max_size=0)
+        cache.put("a", "A")
+        self.assertIsNone(cache.get("a"))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,21 +1,24 @@
+import importlib.util
 import unittest
 from unittest.mock import patch, Mock
-from searxng_summarizer import SearxngSummarizer
+import torch
+import searxng_summarizer
+from searxng_summarizer import SEARXNG_CACHE_TTL_SECONDS, SearxngSummarizer
 
 class TestSearxngSummarizer(unittest.TestCase):
     def setUp(self):
         self.searxng_instance_url = "http://example.com"
         self.summarizer = SearxngSummarizer(self.searxng_instance_url)
 
-    @patch("requests.get")
+    @patch("requests.Session.get")
     def test_search_searxng(self, mock_get):
         # Mock the response from SearXNG
         mock_response = Mock()
         mock_response.status_code = 200
         mock_response.json.return_value = {
             "results": [
-                {"title": "Test Result 1", "url": "http://example.com/1", "score": 0.9},
-                {"title": "Test Result 2", "url": "http://example.com/2", "score": 0.8},
+                {"title": "Test Result 1", "url": "http://example.com/1", "score": 2.9},
+                {"title": "Test Result 2", "url": "http://example.com/2", "score": 1.8},
             ]
         }
         mock_get.return_value = mock_response
@@ -26,43 +29,155 @@ class TestSearxngSummarizer(unittest.TestCase):
         self.assertEqual(results[0]["title"], "Test Result 1")
         self.assertEqual(results[1]["url"], "http://example.com/2")
 
-    @patch("requests.get")
+    @patch("requests.Session.get")
+    def test_search_results_are_cached_as_copies(self, mock_get):
+        mock_response = Mock()
+        mock_response.json.return_value = {
+            "results": [{"title": "Test Result", "url": "http://example.com", "content": "Snippet", "score": 2.0}]
+        }
+        mock_get.return_value = mock_response
+
+        results = self.summarizer.search_searxng("Test  Query")
+        results[0]["content"] = "Rewritten by the caller"
+
+        # The same query, differently spaced and cased, is answered from the cache with the original results
+        cached_results = self.summarizer.search_searxng(" test query ")
+        self.assertEqual(mock_get.call_count, 1)
+        self.assertEqual(cached_results[0]["content"], "Snippet")
+
+    @patch("searxng_summarizer.time.monotonic")
+    @patch("requests.Session.get")
+    def test_expired_search_results_are_fetched_again(self, mock_get, mock_monotonic):
+        mock_response = Mock()
+        mock_response.json.return_value = {"results": []}
+        mock_get.return_value = mock_response
+
+        mock_monotonic.return_value = 100.0
+        self.summarizer.search_searxng("test query")
+        mock_monotonic.return_value = 100.0 + SEARXNG_CACHE_TTL_SECONDS + 1
+        self.summarizer.search_searxng("test query")
+        self.assertEqual(mock_get.call_count, 2)
+
+    @patch("requests.Session.get")
+    def test_search_keeps_best_results_in_score_order(self, mock_get):
+        scores = [1.6, 4.0, 0.5, 2.5, 3.0, 1.0]
+        mock_response = Mock()
+        mock_response.json.return_value = {
+            "results": [{"title": f"Result {index}", "url": f"http://example.com/{index}", "score": score}
+                        for index, score in enumerate(scores)]
+        }
+        mock_get.return_value = mock_response
+
+        with patch("searxng_summarizer.SEARXNG_MAX_RESULTS", 3):
+            results = self.summarizer.search_searxng("test query")
+        self.assertEqual([result["score"] for result in results], [4.0, 3.0, 2.5])
+
+    @patch("requests.Session.get")
     def test_fetch_webpage_content(self, mock_get):
         # Mock the response from a webpage
         mock_response = Mock()
         mock_response.status_code = 200
-        mock_response.text = "<html><body><p>Test content</p></body></html>"
+        mock_response.raw.read.return_value = b"<html><body><p>Test content</p><script>var x;</script></body></html>"
         mock_get.return_value = mock_response
 
         # Test the fetch function
         content = self.summarizer.fetch_webpage_content("http://example.com")
         self.assertEqual(content, "Test content")
 
-    @patch.object(SearxngSummarizer, "summarizer", new_callable=Mock)
-    def test_summarize_text(self, mock_summarizer):
-        # Mock the summarization pipeline
-        mock_summarizer.return_value = [{"summary_text": "Test summary"}]
+    @patch.object(SearxngSummarizer, "load_summarization_model")
+    def test_summarize(self, mock_load):
+        # Mock the LongT5 tokenizer and model
+        mock_tokenizer, mock_model = Mock(), Mock()
+        mock_tokenizer.return_value = {"input_ids": torch.ones((1, 20), dtype=torch.long)}
+        mock_tokenizer.decode.return_value = "Test summary"
+        mock_model.device = torch.device("cpu")
+        mock_model.generate.return_value = torch.ones((1, 6), dtype=torch.long)
+        mock_load.return_value = (mock_tokenizer, mock_model)
 
         # Test the summarize function
-        summary = self.summarizer.summarize_text("Test content")
+        summary = self.summarizer.summarize("Test content")
         self.assertEqual(summary, "Test summary")
+        mock_tokenizer.assert_called_once()
+        self.assertEqual(mock_tokenizer.call_args.args[0], "summarize: Test content")
+        self.assertEqual(mock_model.generate.call_args.kwargs["max_length"], 6)   # 30% of the 20 input tokens
 
+    @patch("searxng_summarizer.SEARXNG_SUMMARIZE", False)
     @patch("searxng_summarizer.SearxngSummarizer.search_searxng")
-    @patch("searxng_summarizer.SearxngSummarizer.fetch_webpage_content")
-    @patch("searxng_summarizer.SearxngSummarizer.summarize_text")
-    def test_process_query(self, mock_summarize, mock_fetch, mock_search):
-        # Mock the search, fetch, and summarize functions
+    def test_process_query(self, mock_search):
+        # Mock the search function
         mock_search.return_value = [
-            {"title": "Test Result", "url": "http://example.com", "score": 0.9}
+            {"title": "Test Result", "url": "http://example.com", "content": "Test content", "score": 1.9},
+            {"title": "Other Result", "url": "http://example.com/other", "content": "Other content", "score": 1.6},
         ]
-        mock_fetch.return_value = "Test content"
-        mock_summarize.return_value = "Test summary"
-
-        # Test the process_query function
-        results = self.summarizer.process_query("test query")
-        self.assertEqual(len(results), 1)
-        self.assertEqual(results[0]["title"], "Test Result")
-        self.assertEqual(results[0]["summary"], "Test summary")
+
+        # Test the process_query function, which joins the results into the context text
+        context = self.summarizer.process_query("test query")
+        self.assertEqual(
+            context,
+            "Test Result\nhttp://example.com\nTest content\n\n"
+            "Other Result\nhttp://example.com/other\nOther content\n\n",
+        )
+
+    @patch("searxng_summarizer.SEARXNG_SUMMARIZE", True)
+    @patch.object(SearxngSummarizer, "summarize_many")
+    @patch.object(SearxngSummarizer, "search_searxng")
+    def test_process_query_summarizes_results_in_one_batch(self, mock_search, mock_summarize_many):
+        mock_search.return_value = [
+            {"title": "Result A", "url": "http://example.com/a", "content": "Long text A", "score": 3.0},
+            {"title": "Result B", "url": "http://example.com/b", "content": "", "score": 2.0},
+            {"title": "Result C", "url": "http://example.com/c", "content": "Long text C", "score": 1.5},
+        ]
+        mock_summarize_many.return_value = ["Summary A", "Summary C"]
+
+        context = self.summarizer.process_query("test query")
+        mock_summarize_many.assert_called_once_with(["Long text A", "Long text C"])
+        self.assertIn("Result A\nhttp://example.com/a\nSummary A\n\n", context)
+        self.assertIn("Result C\nhttp://example.com/c\nSummary C\n\n", context)
+        self.assertNotIn("Long text", context)
+
+
+ARTICLE_HTML = b"""<html><head><title>Page title</title><style>p { color: red; }</style></head>
+<body>
+<nav><a href="/">Home</a></nav>
+<h1>Main heading</h1>
+<p>First paragraph.</p>
+<script>var tracking = "script text";</script>
+<h2>Section</h2><h3>Sub</h3><h4>Four</h4><h5>Five</h5><h6>Six</h6>
+<ul><li>Plain item</li><li><p>Item paragraph</p></li></ul>
+<noscript>Enable JavaScript</noscript>
+</body></html>"""
+
+PLAIN_HTML = b"<html><body><div>Only a div <span>with text</span></div><script>var x;</script></body></html>"
+
+
+class ExtractTextTests:
+    """
+    Tests of extract_text, run with each HTML parser it supports.
+    """
+
+    def test_keeps_content_elements_only(self):
+        text = SearxngSummarizer.extract_text(ARTICLE_HTML)
+        for kept in ("Main heading", "First paragraph.", "Section", "Sub", "Four", "Five", "Six", "Plain item"):
+            self.assertIn(kept, text)
+        for dropped in ("Home", "script text", "color: red", "Enable JavaScript", "Page title"):
+            self.assertNotIn(dropped, text)
+
+    def test_list_item_wrapping_a_paragraph_is_kept_once(self):
+        self.assertEqual(SearxngSummarizer.extract_text(ARTICLE_HTML).count("Item paragraph"), 1)
+
+    def test_falls_back_to_body_text(self):
+        self.assertEqual(SearxngSummarizer.extract_text(PLAIN_HTML), "Only a div with text")
+
+
+@unittest.skipIf(searxng_summarizer.HTMLParser is None, "selectolax is not installed")
+class TestExtractTextWithSelectolax(ExtractTextTests, unittest.TestCase):
+    pass
+
+
+@unittest.skipIf(importlib.util.find_spec("lxml") is None, "lxml is not installed")
+@patch("searxng_summarizer.HTMLParser", None)
+class TestExtractTextWithLxml(ExtractTextTests, unittest.TestCase):
+    pass
 
 
 if __name__ == "__main__":
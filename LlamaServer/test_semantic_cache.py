@@ -0,0 +1,65 @@
+import sys
+import types
+import unittest
+from unittest.mock import patch
+
+try:
+    import faiss
+    import numpy as np
+except ImportError:
+    faiss = None
+
+
+class FakeSentenceTransformer:
+    """
+    Embeds each distinct prompt as its own unit vector, so equal prompts match and different ones do not.
+    """
+    dimension = 8
+
+    def __init__(self, model_name):
+        self.vocabulary = {}
+
+    def get_sentence_embedding_dimension(self):
+        return self.dimension
+
+    def encode(self, prompts, convert_to_numpy=True, normalize_embeddings=True):
+        embeddings = np.zeros((len(prompts), self.dimension), dtype="float32")
+        for row, prompt in enumerate(prompts):
+            embeddings[row, self.vocabulary.setdefault(prompt, len(self.vocabulary))] = 1.0
+        return embeddings
+
+
+@unittest.skipIf(faiss is None, "faiss is not installed")
+class TestSemanticCache(unittest.TestCase):
+    def setUp(self):
+        fake_module = types.SimpleNamespace(SentenceTransformer=FakeSentenceTransformer)
+        with patch.dict(sys.modules, {"sentence_transformers": fake_module}):
+            from semantic_cache import SemanticCache
+            self.cache = SemanticCache(threshold=0.95, ttl_seconds=60, max_size=2)
+
+    def test_get_returns_stored_reply(self):
+        self.cache.put_many(["What is RAG?"], ["Retrieval-Augmented Generation."])
+        self.assertEqual(self.cache.get_many(["What is RAG?", "Another question"]), ["Retrieval-Augmented Generation.", None])
+
+    @patch("semantic_cache.time.time")
+    def test_expired_reply_is_replaced_on_reinsert(self, mock_time):
+        mock_time.return_value = 100.0
+        self.cache.put_many(["What is RAG?"], ["Old reply"])
+        mock_time.return_value = 161.0
+        self.assertEqual(self.cache.get_many(["What is RAG?"]), [None])
+
+        self.cache.put_many(["What is RAG?"], ["New reply"])
+        self.assertEqual(self.cache.get_many(["What is RAG?"]), ["New reply"])
+        self.assertEqual(len(self.cache), 1)
+        self.assertEqual(self.cache.index.ntotal, 1)
+
+    def test_oldest_reply_is_evicted_when_full(self):
+        self.cache.put_many(["a", "b"], ["A", "B"])
+        self.cache.put_many(["c"], ["C"])
+        self.assertEqual(len(self.cache), 2)
+        self.assertEqual(self.cache.index.ntotal, 2)
+        self.assertEqual(self.cache.get_many(["a", "b", "c"]), [None, "B", "C"])
+
+
+if __name__ == "__main__":
+    unittest.main()